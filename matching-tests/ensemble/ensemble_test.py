@@ -1,12 +1,17 @@
 import csv
+import time
 import argparse
+import itertools
 import logging
-import requests
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from predictor import Predictor
-from timer import LoopTimerContext
+from predictor import Predictor, PredictorClient
+from timer import LoopTimerContext, read_chunks
+from ror_client import add_client_arguments, client_from_args, get_chosen_result
 
-PREDICTOR = Predictor('models/')
+PREDICTOR = None
+ROR_CLIENT = None
 now = datetime.now()
 script_start = now.strftime("%Y%m%d_%H%M%S")
 logging.basicConfig(filename=f'{script_start}_ensemble_test.log', level=logging.ERROR, format='%(asctime)s %(levelname)s %(message)s')
@@ -15,26 +20,28 @@ logging.basicConfig(filename=f'{script_start}_ensemble_test.log', level=logging.
 def query_affiliation(affiliation):
 	chosen_result = None
 	try:
-		url = "https://api.ror.org/organizations"
-		params = {"affiliation": affiliation}
-		r = requests.get(url, params=params)
-		api_response = r.json()
-		results = api_response['items']
-		if results:
-			for result in results:
-				if result['chosen']:
-					chosen_id = result['organization']['id']
-					score = result['score']
-					chosen_result = chosen_id, score
-					break
+		results = ROR_CLIENT.query(affiliation)
+		chosen_result = get_chosen_result(results)
 	except Exception as e:
 		logging.error(f'Error for query: {affiliation} - {e}')
 	return chosen_result
 
 
+def predict_fasttext(affiliation, min_fasttext_probability):
+	# The predictor returns (None, None) below the threshold. Misses are None here, as
+	# for the API, so either strategy's result can be tested for a match.
+	prediction = PREDICTOR.predict_ror_id(affiliation, min_fasttext_probability)
+	return prediction if prediction[0] else None
+
+
+def predict_fasttext_batch(affiliations, min_fasttext_probability):
+	return [prediction if prediction[0] else None
+			for prediction in PREDICTOR.predict_ror_ids(affiliations, min_fasttext_probability)]
+
+
 def ensemble_match(affiliation, min_fasttext_probability, match_order='fasttext'):
 	if match_order == 'fasttext':
-		fasttext_prediction = PREDICTOR.predict_ror_id(
+		fasttext_prediction = predict_fasttext(
 			affiliation, min_fasttext_probability)
 		if fasttext_prediction:
 			return fasttext_prediction
@@ -47,11 +54,68 @@ def ensemble_match(affiliation, min_fasttext_probability, match_order='fasttext'
 		if ror_aff_prediction:
 			return ror_aff_prediction
 		else:
-			fasttext_prediction = PREDICTOR.predict_ror_id(
+			fasttext_prediction = predict_fasttext(
 				affiliation, min_fasttext_probability)
 			return fasttext_prediction
 
 
+class SpeculationStats():
+	def __init__(self):
+		self.rows = 0
+		self.fallbacks = 0
+		self.api_queries = 0
+		self.discarded = 0
+		self.max_in_flight = 0
+
+	def record(self, fell_back, queried_api, discarded):
+		self.rows += 1
+		if fell_back:
+			self.fallbacks += 1
+		if queried_api:
+			self.api_queries += 1
+		if discarded:
+			self.discarded += 1
+
+	def write_stats_to_csv(self, filename="ensemble_speculation_stats.csv"):
+		with open(filename, 'w', newline='') as f_out:
+			writer = csv.writer(f_out)
+			writer.writerow(['Metric', 'Value'])
+			writer.writerow(['rows', self.rows])
+			# Rows where the first strategy missed and the second one was used
+			writer.writerow(['fallback_rows', self.fallbacks])
+			writer.writerow(['api_queries', self.api_queries])
+			# Speculative fasttext predictions that lost to an API match
+			writer.writerow(['fasttext_predictions_discarded', self.discarded])
+			writer.writerow(['max_api_queries_in_flight', self.max_in_flight])
+
+
+def speculate_row(affiliation, min_fasttext_probability, match_order, executor):
+	# Runs in the main thread when a row enters the window. fastText is cheap, so it runs
+	# at once; the API query, when needed, is submitted to the pool and left in flight
+	# while later rows are read. Under the fasttext order the API is only queried for
+	# rows fastText misses. Under the affiliation order it is queried for every row and
+	# the fastText prediction is kept as the fallback.
+	fasttext_prediction = predict_fasttext(affiliation, min_fasttext_probability)
+	if match_order == 'fasttext' and fasttext_prediction:
+		return fasttext_prediction, None
+	return fasttext_prediction, executor.submit(query_affiliation, affiliation)
+
+
+def resolve_row(fasttext_prediction, api_future, match_order, speculation_stats):
+	if api_future is None:
+		speculation_stats.record(False, False, False)
+		return fasttext_prediction
+	ror_aff_prediction = api_future.result()
+	if match_order == 'fasttext':
+		speculation_stats.record(True, True, False)
+		return ror_aff_prediction
+	if ror_aff_prediction:
+		speculation_stats.record(False, True, fasttext_prediction is not None)
+		return ror_aff_prediction
+	speculation_stats.record(True, True, False)
+	return fasttext_prediction
+
+
 def parse_and_query(input_file, output_file, min_fasttext_probability, match_order):
 	try:
 		timed = LoopTimerContext()
@@ -76,6 +140,108 @@ def parse_and_query(input_file, output_file, min_fasttext_probability, match_ord
 		logging.error(f'Error in parse_and_query: {e}')
 
 
+def parse_and_query_speculative(input_file, output_file, min_fasttext_probability, match_order, speculative_workers):
+	# Rows are matched ahead of the one being written, in a bounded window of twice the
+	# number of workers, so up to speculative_workers API queries are in flight at once.
+	# Results are written in input order, and each row's time is measured from when it
+	# entered the window to when its result was written.
+	try:
+		timed = LoopTimerContext()
+		speculation_stats = SpeculationStats()
+		window_size = 2 * speculative_workers
+		with open(input_file, 'r+', encoding='utf-8-sig') as f_in, open(output_file, 'w') as f_out, ThreadPoolExecutor(max_workers=speculative_workers) as executor:
+			reader = csv.DictReader(f_in)
+			fieldnames = reader.fieldnames + \
+				["predicted_ror_id", "prediction_score"]
+			writer = csv.DictWriter(f_out, fieldnames=fieldnames)
+			writer.writeheader()
+			window = deque()
+			try:
+				# None marks the end of the input, where the window is drained
+				for row in itertools.chain(reader, [None]):
+					if row is not None:
+						start = time.perf_counter()
+						fasttext_prediction, api_future = speculate_row(
+							row['affiliation'], min_fasttext_probability, match_order, executor)
+						window.append((row, start, fasttext_prediction, api_future))
+						in_flight = sum(1 for *_, future in window if future is not None and future.running())
+						speculation_stats.max_in_flight = max(speculation_stats.max_in_flight, in_flight)
+					while window and (row is None or len(window) >= window_size):
+						head_row, start, fasttext_prediction, api_future = window.popleft()
+						prediction = resolve_row(fasttext_prediction, api_future, match_order, speculation_stats)
+						predicted_id, prediction_score = prediction if prediction else (None, None)
+						head_row.update({
+							"predicted_ror_id": predicted_id,
+							"prediction_score": prediction_score,
+						})
+						writer.writerow(head_row)
+						timed.record(time.perf_counter() - start)
+			finally:
+				# On an error, queries for rows that will not be written are cancelled if
+				# they have not started
+				for *_, api_future in window:
+					if api_future is not None:
+						api_future.cancel()
+		speculation_stats.write_stats_to_csv()
+		return timed
+	except Exception as e:
+		logging.error(f'Error in parse_and_query_speculative: {e}')
+
+
+def pipeline_match_chunk(affiliations, min_fasttext_probability, match_order, executor):
+	# The first strategy runs over the whole chunk, then only its misses go to the
+	# second. API queries are spread over the executor and map keeps them in order.
+	if match_order == 'fasttext':
+		predictions = predict_fasttext_batch(affiliations, min_fasttext_probability)
+		misses = [i for i, prediction in enumerate(predictions) if not prediction]
+		ror_aff_predictions = executor.map(query_affiliation, [affiliations[i] for i in misses])
+		for i, ror_aff_prediction in zip(misses, ror_aff_predictions):
+			predictions[i] = ror_aff_prediction
+	else:
+		predictions = list(executor.map(query_affiliation, affiliations))
+		misses = [i for i, prediction in enumerate(predictions) if not prediction]
+		fasttext_predictions = predict_fasttext_batch(
+			[affiliations[i] for i in misses], min_fasttext_probability)
+		for i, fasttext_prediction in zip(misses, fasttext_predictions):
+			predictions[i] = fasttext_prediction
+	return predictions
+
+
+def parse_and_query_pipeline(input_file, output_file, min_fasttext_probability, match_order, batch_size, concurrency):
+	try:
+		timed = LoopTimerContext()
+		with open(input_file, 'r+', encoding='utf-8-sig') as f_in, open(output_file, 'w') as f_out, ThreadPoolExecutor(max_workers=concurrency) as executor:
+			reader = csv.DictReader(f_in)
+			fieldnames = reader.fieldnames + \
+				["predicted_ror_id", "prediction_score"]
+			writer = csv.DictWriter(f_out, fieldnames=fieldnames)
+			writer.writeheader()
+			for chunk in read_chunks(reader, batch_size):
+				with timed:
+					affiliations = [row['affiliation'] for row in chunk]
+					predictions = pipeline_match_chunk(
+						affiliations, min_fasttext_probability, match_order, executor)
+					for row, prediction in zip(chunk, predictions):
+						predicted_id, prediction_score = prediction if prediction else (None, None)
+						row.update({
+							"predicted_ror_id": predicted_id,
+							"prediction_score": prediction_score,
+						})
+					writer.writerows(chunk)
+		return timed
+	except Exception as e:
+		logging.error(f'Error in parse_and_query_pipeline: {e}')
+
+
+def write_server_stats_to_csv(server_stats, filename="ensemble_server_stats.csv"):
+	with open(filename, 'w', newline='') as f_out:
+		writer = csv.writer(f_out)
+		writer.writerow(['Metric', 'Value'])
+		for metric, value in server_stats.items():
+			if metric != 'cache':
+				writer.writerow([metric, value])
+
+
 def parse_arguments():
 	parser = argparse.ArgumentParser(
 		description='Return ensemble (ROR affiliation + fasttext) matches for a given CSV file.')
@@ -86,14 +252,35 @@ def parse_arguments():
 		'-p', '--min_fasttext_probability', help='min_fasttext_probability level for the fasttext predictor', type=float, default=0.7)
 	parser.add_argument('-m', '--match_order', choices=['fasttext', 'affiliation'],
 						help='Order of matching methods ("fasttext" or "affiliation")', default='fasttext')
+	parser.add_argument('-s', '--server', help='URL of a running matcher_daemon.py (e.g. http://127.0.0.1:8765) to send fasttext predictions to instead of loading the model', default=None)
+	parser.add_argument('-x', '--speculative', help='Match rows ahead of the one being written, keeping ROR affiliation API queries for several rows in flight, with results written in input order', action='store_true')
+	parser.add_argument('--speculative_workers', help='Maximum number of concurrent ROR affiliation API queries in speculative mode', type=int, default=4)
+	parser.add_argument('--pipeline', help='Match in chunks: run the first method over the whole chunk, then only its misses through the second, with concurrent API queries', action='store_true')
+	parser.add_argument('-b', '--batch_size', help='Number of rows per chunk in pipeline mode', type=int, default=1000)
+	parser.add_argument('--concurrency', help='Maximum number of concurrent ROR affiliation API queries in pipeline mode', type=int, default=8)
+	add_client_arguments(parser)
 	return parser.parse_args()
 
 
 def main():
+	global PREDICTOR, ROR_CLIENT
 	args = parse_arguments()
-	timed = parse_and_query(args.input, args.output,
+	# Enough pooled connections for every thread that may query the API at once
+	ROR_CLIENT = client_from_args(args, pool_size=max(10, args.concurrency if args.pipeline else args.speculative_workers))
+	PREDICTOR = PredictorClient(args.server) if args.server else Predictor('models/')
+	if args.pipeline:
+		timed = parse_and_query_pipeline(args.input, args.output, args.min_fasttext_probability,
+					args.match_order, args.batch_size, args.concurrency)
+	elif args.speculative:
+		timed = parse_and_query_speculative(args.input, args.output, args.min_fasttext_probability,
+					args.match_order, args.speculative_workers)
+	else:
+		timed = parse_and_query(args.input, args.output,
 					args.min_fasttext_probability, args.match_order)
 	timed.write_stats_to_csv("ensemble_timing_stats.csv")
+	ROR_CLIENT.stats.write_stats_to_csv("ensemble_api_stats.csv")
+	if args.server:
+		write_server_stats_to_csv(PREDICTOR.get_server_stats())
 
 
 if __name__ == '__main__':
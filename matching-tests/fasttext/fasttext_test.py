@@ -1,27 +1,62 @@
+import gc
+import os
+import sys
 import csv
+import time
+import resource
 import argparse
 import logging
+import multiprocessing
+from collections import deque
 from datetime import datetime
-from predictor import Predictor
-from timer import LoopTimerContext
+from predictor import Predictor, PredictorClient
+from timer import LoopTimerContext, read_chunks
+from calculate_f_score import calculate_match, calculate_counts, calculate_metrics
 
-PREDICTOR = Predictor('models/')
+PREDICTOR = None
 now = datetime.now()
 script_start = now.strftime("%Y%m%d_%H%M%S")
 logging.basicConfig(filename=f'{script_start}_ensemble_test.log', level=logging.ERROR, format='%(asctime)s %(levelname)s %(message)s')
 
 
-def parse_and_query(input_file, output_file, min_fasttext_probability):
+def get_fieldnames(reader, top_k):
+    fieldnames = reader.fieldnames + ["predicted_ror_id", "prediction_score"]
+    if top_k:
+        fieldnames += ["top_k_ror_ids", "top_k_scores"]
+    return fieldnames
+
+
+def update_with_top_k(row, candidates, min_fasttext_probability):
+    # The best candidate is only the prediction if it clears the threshold, as in
+    # predict_ror_id. All k candidates are kept so other thresholds can be applied offline.
+    if candidates and candidates[0][1] >= min_fasttext_probability:
+        predicted_ror_id, prediction_score = candidates[0]
+    else:
+        predicted_ror_id, prediction_score = None, None
+    row.update({
+        "predicted_ror_id": predicted_ror_id,
+        "prediction_score": prediction_score,
+        "top_k_ror_ids": '; '.join(label for label, _ in candidates),
+        "top_k_scores": '; '.join(f'{score:.6f}' for _, score in candidates)
+    })
+
+
+def parse_and_query(input_file, output_file, min_fasttext_probability, top_k=None):
     try:
         timed = LoopTimerContext()
         with open(input_file, 'r+', encoding='utf-8-sig') as f_in, open(output_file, 'w') as f_out:
             reader = csv.DictReader(f_in)
-            fieldnames = reader.fieldnames + ["predicted_ror_id", "prediction_score"]
+            fieldnames = get_fieldnames(reader, top_k)
             writer = csv.DictWriter(f_out, fieldnames=fieldnames)
             writer.writeheader()
             for row in reader:
                 with timed:
                     affiliation = row['affiliation']
+                    if top_k:
+                        candidates = PREDICTOR.predict_top_k(affiliation, top_k)
+                        update_with_top_k(row, candidates, min_fasttext_probability)
+                        writer.writerow(row)
+                        continue
                     fasttext_prediction = PREDICTOR.predict_ror_id(
                         affiliation, min_fasttext_probability)
                     predicted_ror_id, prediction_score = fasttext_prediction
@@ -35,6 +70,165 @@ def parse_and_query(input_file, output_file, min_fasttext_probability):
         logging.error(f'Error in parse_and_query: {e}')
 
 
+def predict_chunk(chunk, min_fasttext_probability, top_k=None):
+    start = time.perf_counter()
+    affiliations = [row['affiliation'] for row in chunk]
+    if top_k:
+        all_candidates = PREDICTOR.predict_top_k_batch(affiliations, top_k)
+        for row, candidates in zip(chunk, all_candidates):
+            update_with_top_k(row, candidates, min_fasttext_probability)
+        return chunk, time.perf_counter() - start
+    fasttext_predictions = PREDICTOR.predict_ror_ids(
+        affiliations, min_fasttext_probability)
+    for row, (predicted_ror_id, prediction_score) in zip(chunk, fasttext_predictions):
+        row.update({
+            "predicted_ror_id": predicted_ror_id,
+            "prediction_score": prediction_score
+        })
+    return chunk, time.perf_counter() - start
+
+
+def parse_and_query_chunked(input_file, output_file, min_fasttext_probability, batch_size, top_k=None):
+    try:
+        timed = LoopTimerContext()
+        with open(input_file, 'r+', encoding='utf-8-sig') as f_in, open(output_file, 'w') as f_out:
+            reader = csv.DictReader(f_in)
+            fieldnames = get_fieldnames(reader, top_k)
+            writer = csv.DictWriter(f_out, fieldnames=fieldnames)
+            writer.writeheader()
+            for chunk in read_chunks(reader, batch_size):
+                with timed:
+                    predicted_chunk, _ = predict_chunk(chunk, min_fasttext_probability, top_k)
+                    writer.writerows(predicted_chunk)
+        return timed
+    except Exception as e:
+        logging.error(f'Error in parse_and_query_chunked: {e}')
+
+
+def parse_and_query_parallel(input_file, output_file, min_fasttext_probability, batch_size, workers, top_k=None):
+    try:
+        timed = LoopTimerContext()
+        # Workers are forked after the model is loaded, so they share its pages
+        # copy-on-write. Freezing the GC keeps collections in the workers from
+        # touching (and so copying) the parent's object pages.
+        gc.freeze()
+        context = multiprocessing.get_context('fork')
+        with open(input_file, 'r+', encoding='utf-8-sig') as f_in, open(output_file, 'w') as f_out, context.Pool(workers) as pool:
+            reader = csv.DictReader(f_in)
+            fieldnames = get_fieldnames(reader, top_k)
+            writer = csv.DictWriter(f_out, fieldnames=fieldnames)
+            writer.writeheader()
+            # Chunks are written in submission order, so output matches input order.
+            # Bounding the number of pending chunks keeps memory flat on large inputs.
+            pending = deque()
+            for chunk in read_chunks(reader, batch_size):
+                pending.append(pool.apply_async(
+                    predict_chunk, (chunk, min_fasttext_probability, top_k)))
+                if len(pending) >= workers * 2:
+                    predicted_chunk, elapsed = pending.popleft().get()
+                    timed.record(elapsed)
+                    writer.writerows(predicted_chunk)
+            while pending:
+                predicted_chunk, elapsed = pending.popleft().get()
+                timed.record(elapsed)
+                writer.writerows(predicted_chunk)
+        return timed
+    except Exception as e:
+        logging.error(f'Error in parse_and_query_parallel: {e}')
+    finally:
+        gc.unfreeze()
+
+
+def get_rss_mb():
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    # No procfs (e.g. macOS), so fall back to peak RSS, which is reported in bytes there
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return max_rss / 1024 ** 2 if sys.platform == 'darwin' else max_rss / 1024
+
+
+def benchmark_model(model_file, input_file, min_fasttext_probability):
+    rss_before_load = get_rss_mb()
+    start = time.perf_counter()
+    predictor = Predictor('models/', use_cache=False, model_file=model_file)
+    load_time = time.perf_counter() - start
+    rss_after_load = get_rss_mb()
+    timed = LoopTimerContext()
+    results_set = []
+    with open(input_file, 'r+', encoding='utf-8-sig') as f_in:
+        reader = csv.DictReader(f_in)
+        for row in reader:
+            with timed:
+                predicted_ror_id, prediction_score = predictor.predict_ror_id(
+                    row['affiliation'], min_fasttext_probability)
+            row['predicted_ror_id'] = predicted_ror_id
+            row['match'] = calculate_match(row)
+            results_set.append(row)
+    true_pos, false_pos, false_neg, true_neg = calculate_counts(results_set)
+    precision, recall, f1_score, f0_5_score, specificity = calculate_metrics(
+        true_pos, false_pos, false_neg, true_neg)
+    percentiles = timed.get_percentiles((50, 90, 99))
+    return {
+        'model_file': model_file,
+        'model_size_mb': os.path.getsize(predictor.model) / 1024 ** 2,
+        'load_time': load_time,
+        'model_rss_mb': rss_after_load - rss_before_load,
+        'total_rss_mb': get_rss_mb(),
+        'rows': len(results_set),
+        'latency_p50': percentiles[50],
+        'latency_p90': percentiles[90],
+        'latency_p99': percentiles[99],
+        'latency_max': max(timed.execution_times),
+        'precision': precision,
+        'recall': recall,
+        'f1_score': f1_score,
+        'f0_5_score': f0_5_score,
+        'specificity': specificity,
+    }
+
+
+def compare_models(model_files, input_file, min_fasttext_probability):
+    # Each model is loaded and benchmarked in a fresh process, so the RSS figures
+    # are not skewed by memory the allocator kept from a previously loaded model
+    context = multiprocessing.get_context('spawn')
+    comparison = []
+    for model_file in model_files:
+        with context.Pool(1) as pool:
+            comparison.append(pool.apply(
+                benchmark_model, (model_file, input_file, min_fasttext_probability)))
+    return comparison
+
+
+def write_comparison_to_csv(comparison, filename="fasttext_model_comparison.csv"):
+    with open(filename, 'w', newline='') as f_out:
+        writer = csv.DictWriter(f_out, fieldnames=list(comparison[0].keys()))
+        writer.writeheader()
+        writer.writerows(comparison)
+
+
+def write_cache_stats_to_csv(cache_stats, filename="fasttext_cache_stats.csv"):
+    with open(filename, 'w', newline='') as f_out:
+        fieldnames = ['cache', 'size', 'max_size', 'hits', 'misses', 'evictions']
+        writer = csv.DictWriter(f_out, fieldnames=fieldnames)
+        writer.writeheader()
+        for cache_name, stats in cache_stats.items():
+            writer.writerow({'cache': cache_name, **stats})
+
+
+def write_server_stats_to_csv(server_stats, filename="fasttext_server_stats.csv"):
+    with open(filename, 'w', newline='') as f_out:
+        writer = csv.writer(f_out)
+        writer.writerow(['Metric', 'Value'])
+        for metric, value in server_stats.items():
+            if metric != 'cache':
+                writer.writerow([metric, value])
+
+
 def parse_arguments():
     parser = argparse.ArgumentParser(
         description='Return fasttext matches for a given CSV file.')
@@ -43,13 +237,48 @@ def parse_arguments():
                         default='fasttext_results.csv')
     parser.add_argument(
         '-p', '--min_fasttext_probability', help='min_fasttext_probability level for the fasttext predictor', type=float, default=0.8)
+    parser.add_argument(
+        '-b', '--batch_size', help='Number of rows to read, predict and write per chunk. If not set, rows are predicted one at a time', type=int, default=None)
+    parser.add_argument(
+        '-c', '--cache_size', help='Maximum number of entries in each of the normalization and prediction caches', type=int, default=100000)
+    parser.add_argument(
+        '--no_cache', help='Disable the normalization and prediction caches (e.g. for benchmarking)', action='store_true')
+    parser.add_argument(
+        '-w', '--workers', help='Number of worker processes to distribute row chunks over. Chunks are --batch_size rows (default 1000)', type=int, default=None)
+    parser.add_argument(
+        '-m', '--model_file', help='Model file in the models/ directory, either full precision (.bin) or quantized (.ftz)', default='model.bin')
+    parser.add_argument(
+        '--compare_models', nargs='+', help='Model files in the models/ directory to compare on the input file for memory, load time, latency and F-scores. Requires a "ror_id" column', default=None)
+    parser.add_argument(
+        '-k', '--top_k', help='Also write the k best ROR IDs and their probabilities from a single prediction, regardless of threshold', type=int, default=None)
+    parser.add_argument(
+        '-s', '--server', help='URL of a running matcher_daemon.py (e.g. http://127.0.0.1:8765) to send predictions to instead of loading the model', default=None)
     return parser.parse_args()
 
 
 def main():
+    global PREDICTOR
     args = parse_arguments()
-    timed = parse_and_query(args.input, args.output, args.min_fasttext_probability)
+    if args.compare_models:
+        comparison = compare_models(args.compare_models, args.input, args.min_fasttext_probability)
+        write_comparison_to_csv(comparison)
+        return
+    if args.server:
+        PREDICTOR = PredictorClient(args.server)
+    else:
+        PREDICTOR = Predictor('models/', cache_size=args.cache_size, use_cache=not args.no_cache, model_file=args.model_file)
+    if args.workers:
+        timed = parse_and_query_parallel(args.input, args.output, args.min_fasttext_probability, args.batch_size or 1000, args.workers, args.top_k)
+    elif args.batch_size:
+        timed = parse_and_query_chunked(args.input, args.output, args.min_fasttext_probability, args.batch_size, args.top_k)
+    else:
+        timed = parse_and_query(args.input, args.output, args.min_fasttext_probability, args.top_k)
     timed.write_stats_to_csv("fasttext_timing_stats.csv")
+    # Each worker keeps its own caches, so the parent's stats are only meaningful single process
+    if PREDICTOR.use_cache and not args.workers:
+        write_cache_stats_to_csv(PREDICTOR.get_cache_stats())
+    if args.server:
+        write_server_stats_to_csv(PREDICTOR.get_server_stats())
 
 
 if __name__ == '__main__':
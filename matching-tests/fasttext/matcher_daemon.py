@@ -0,0 +1,143 @@
+import time
+# Taken before the remaining imports so the reported startup time includes them
+PROCESS_START = time.perf_counter()
+import json
+import argparse
+import logging
+import threading
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from predictor import Predictor
+
+now = datetime.now()
+script_start = now.strftime("%Y%m%d_%H%M%S")
+logging.basicConfig(filename=f'{script_start}_matcher_daemon.log', level=logging.INFO, format='%(asctime)s %(levelname)s %(message)s')
+
+
+class MatcherStats():
+	def __init__(self):
+		self.started = time.perf_counter()
+		self.startup_time = None
+		self.model_load_time = None
+		self.requests = 0
+		self.rows = 0
+		self.busy_time = 0.0
+
+	def record(self, rows, elapsed):
+		self.requests += 1
+		self.rows += rows
+		self.busy_time += elapsed
+
+	def get_stats(self):
+		return {
+			'startup_time': self.startup_time,
+			'model_load_time': self.model_load_time,
+			'uptime': time.perf_counter() - self.started,
+			'requests': self.requests,
+			'rows': self.rows,
+			'busy_time': self.busy_time,
+			'rows_per_second': self.rows / self.busy_time if self.busy_time else None,
+		}
+
+
+class MatcherRequestHandler(BaseHTTPRequestHandler):
+	protocol_version = 'HTTP/1.1'
+	# Headers and body are written separately, so avoid Nagle delays on keep-alive connections
+	disable_nagle_algorithm = True
+
+	def do_GET(self):
+		if self.path != '/stats':
+			self.send_json(404, {'error': f'Unknown path: {self.path}'})
+			return
+		stats = self.server.stats.get_stats()
+		if self.server.predictor.use_cache:
+			stats['cache'] = self.server.predictor.get_cache_stats()
+		self.send_json(200, stats)
+
+	def do_POST(self):
+		if self.path != '/predict':
+			self.send_json(404, {'error': f'Unknown path: {self.path}'})
+			return
+		try:
+			content_length = int(self.headers.get('Content-Length', 0))
+			body = json.loads(self.rfile.read(content_length))
+			if not isinstance(body, dict):
+				raise ValueError('request body must be a JSON object')
+			affiliations = body['affiliations']
+			k = int(body.get('k', 1))
+			min_probability = float(body.get('min_probability', 0.0))
+			# A string would otherwise be predicted one character at a time
+			if not isinstance(affiliations, list) or not all(isinstance(affiliation, str) for affiliation in affiliations):
+				raise ValueError('affiliations must be a list of strings')
+			if k < 1:
+				raise ValueError('k must be at least 1')
+		except (ValueError, KeyError, TypeError) as e:
+			self.send_json(400, {'error': f'Invalid request: {e}'})
+			return
+		# The prediction caches are not thread safe, so inference is serialized while
+		# connections are still accepted and parsed concurrently
+		try:
+			with self.server.lock:
+				start = time.perf_counter()
+				candidates = self.server.predictor.predict_top_k_batch(affiliations, k, min_probability)
+				self.server.stats.record(len(affiliations), time.perf_counter() - start)
+		except Exception as e:
+			logging.error(f'Error predicting batch of {len(affiliations)}: {e}')
+			self.send_json(500, {'error': f'Prediction failed: {e}'})
+			return
+		self.send_json(200, {'candidates': candidates})
+
+	def send_json(self, status, payload):
+		response = json.dumps(payload).encode('utf-8')
+		self.send_response(status)
+		self.send_header('Content-Type', 'application/json')
+		self.send_header('Content-Length', str(len(response)))
+		self.end_headers()
+		self.wfile.write(response)
+
+	def log_message(self, format, *args):
+		logging.debug(format % args)
+
+
+def create_server(host, port, model_file, cache_size, use_cache):
+	stats = MatcherStats()
+	start = time.perf_counter()
+	predictor = Predictor('models/', cache_size=cache_size, use_cache=use_cache, model_file=model_file)
+	stats.model_load_time = time.perf_counter() - start
+	server = ThreadingHTTPServer((host, port), MatcherRequestHandler)
+	server.predictor = predictor
+	server.lock = threading.Lock()
+	server.stats = stats
+	stats.startup_time = time.perf_counter() - PROCESS_START
+	return server
+
+
+def parse_arguments():
+	parser = argparse.ArgumentParser(
+		description='Serve fasttext predictions from a model kept loaded in memory.')
+	parser.add_argument('--host', help='Host to listen on', default='127.0.0.1')
+	parser.add_argument('--port', help='Port to listen on', type=int, default=8765)
+	parser.add_argument('-m', '--model_file', help='Model file in the models/ directory, either full precision (.bin) or quantized (.ftz)', default='model.bin')
+	parser.add_argument('-c', '--cache_size', help='Maximum number of entries in each of the normalization and prediction caches', type=int, default=100000)
+	parser.add_argument('--no_cache', help='Disable the normalization and prediction caches', action='store_true')
+	return parser.parse_args()
+
+
+def main():
+	args = parse_arguments()
+	server = create_server(args.host, args.port, args.model_file, args.cache_size, not args.no_cache)
+	stats = server.stats.get_stats()
+	message = f"Listening on http://{args.host}:{args.port} (startup {stats['startup_time']:.2f}s, model load {stats['model_load_time']:.2f}s)"
+	logging.info(message)
+	print(message)
+	try:
+		server.serve_forever()
+	except KeyboardInterrupt:
+		pass
+	finally:
+		logging.info(f'Shutting down: {json.dumps(server.stats.get_stats())}')
+		server.server_close()
+
+
+if __name__ == '__main__':
+	main()
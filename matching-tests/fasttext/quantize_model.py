@@ -0,0 +1,47 @@
+import os
+import time
+import argparse
+import fasttext
+
+# Suppress erroneous error message on loading model that Meta never fixed
+# https://github.com/facebookresearch/fastText/issues/1067
+fasttext.FastText.eprint = lambda x: None
+
+
+def quantize_model(input_model, output_model, cutoff, dsub, qnorm, retrain, train_file):
+    model = fasttext.load_model(input_model)
+    start = time.perf_counter()
+    model.quantize(input=train_file, cutoff=cutoff, dsub=dsub,
+                   qnorm=qnorm, retrain=retrain)
+    quantize_time = time.perf_counter() - start
+    model.save_model(output_model)
+    return quantize_time
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(
+        description='Quantize a full precision fasttext model (.bin) into a compressed model (.ftz).')
+    parser.add_argument('-i', '--input', help='Full precision model file', default='models/model.bin')
+    parser.add_argument('-o', '--output', help='Quantized model file', default='models/model.ftz')
+    parser.add_argument('-c', '--cutoff', help='Number of words and ngrams to retain (0 keeps all)', type=int, default=0)
+    parser.add_argument('-d', '--dsub', help='Size of each sub-vector used in product quantization', type=int, default=2)
+    parser.add_argument('-q', '--qnorm', help='Quantize the vector norms separately', action='store_true')
+    parser.add_argument('-r', '--retrain', help='Fine-tune the embeddings after applying the cutoff. Requires --train_file', action='store_true')
+    parser.add_argument('-t', '--train_file', help='Training data in fasttext format, used when retraining', default=None)
+    args = parser.parse_args()
+    if args.retrain and not args.train_file:
+        parser.error('--retrain requires --train_file')
+    return args
+
+
+def main():
+    args = parse_arguments()
+    quantize_time = quantize_model(args.input, args.output, args.cutoff,
+                                   args.dsub, args.qnorm, args.retrain, args.train_file)
+    input_size = os.path.getsize(args.input) / 1024 ** 2
+    output_size = os.path.getsize(args.output) / 1024 ** 2
+    print(f"Quantized {args.input} ({input_size:.1f} MB) to {args.output} ({output_size:.1f} MB) in {quantize_time:.1f}s")
+
+
+if __name__ == '__main__':
+    main()
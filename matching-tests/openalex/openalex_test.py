@@ -2,9 +2,14 @@ import csv
 import json
 import time
 import argparse
+import itertools
 import logging
+import threading
 import requests
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from requests.adapters import HTTPAdapter
 from timer import LoopTimerContext
 
 now = datetime.now()
@@ -12,14 +17,27 @@ script_start = now.strftime("%Y%m%d_%H%M%S")
 logging.basicConfig(filename=f'{script_start}_openalex_test.log', level=logging.ERROR,
 					format='%(asctime)s %(levelname)s %(message)s')
 
-def openalex_prediction(affiliation_string):
-	url = 'http://127.0.0.1:5000/invocations'
-	test_data ={'affiliation_string':[affiliation_string]}
-	response = requests.post(url, json = test_data).json()
-	return response[0]['ror_id']
+DEFAULT_URL = 'http://127.0.0.1:5000/invocations'
+# One keep-alive session, so a connection is reused across requests instead of opened per row
+SESSION = requests.Session()
+SESSION.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=1))
 
 
-def parse_and_query(input_file, output_file):
+def openalex_predictions(affiliation_strings, url=DEFAULT_URL):
+	test_data = {'affiliation_string': affiliation_strings}
+	response = SESSION.post(url, json=test_data)
+	response.raise_for_status()
+	predictions = response.json()
+	if len(predictions) != len(affiliation_strings):
+		raise ValueError(f'Expected {len(affiliation_strings)} predictions, got {len(predictions)}')
+	return [prediction['ror_id'] for prediction in predictions]
+
+
+def openalex_prediction(affiliation_string, url=DEFAULT_URL):
+	return openalex_predictions([affiliation_string], url)[0]
+
+
+def parse_and_query(input_file, output_file, url):
 	try:
 		timed = LoopTimerContext()
 		with open(input_file, 'r+', encoding='utf-8-sig') as f_in, open(output_file, 'w', newline='') as f_out:
@@ -28,27 +46,296 @@ def parse_and_query(input_file, output_file):
 			writer.writerow(
 				reader.fieldnames + ["predicted_ror_id"])
 			for row in reader:
-				affiliation = row['affiliation']
-				predicted_ror_id = openalex_prediction(
-					affiliation)
-				new_row =  list(row.values()) + [predicted_ror_id]
-				writer.writerow(new_row)
+				with timed:
+					affiliation = row['affiliation']
+					predicted_ror_id = openalex_prediction(
+						affiliation, url)
+					new_row =  list(row.values()) + [predicted_ror_id]
+					writer.writerow(new_row)
 		return timed
 	except Exception as e:
 		logging.error(f'Error in parse_and_query: {e}')
 
 
+class AdaptiveBatchSize():
+	# Doubles the batch size while throughput improves by at least `min_gain` and batches
+	# stay under the latency ceiling, then holds the best size. A batch over the ceiling
+	# falls back to the best smaller size that stayed under it (or half the size if there
+	# is none) and forgets measurements at that size and above. After `probe_after` good
+	# batches at the held size, the next size up is probed with fresh measurements; a
+	# probe that fails doubles the wait before the next one. Throughput per size is
+	# measured over its last `window` full batches. Partial batches at the end of the file
+	# are ignored.
+	def __init__(self, initial_size, max_size, latency_ceiling, min_gain=0.05, probe_after=20, window=5):
+		self.size = initial_size
+		self.max_size = max_size
+		self.latency_ceiling = latency_ceiling
+		self.min_gain = min_gain
+		self.probe_after = probe_after
+		self.probe_interval = probe_after
+		self.window = window
+		self.best_size = initial_size
+		self.growing = True
+		self.probing = False
+		self.good_batches = 0
+		self.measurements = {}
+
+	def throughput(self, size):
+		batches = self.measurements.get(size)
+		if not batches:
+			return 0.0
+		return sum(rows for rows, _ in batches) / sum(elapsed for _, elapsed in batches)
+
+	@property
+	def best_throughput(self):
+		# Measured at best_size, so it is reported alongside the size it belongs to
+		return self.throughput(self.best_size)
+
+	def choose_best_size(self):
+		# A larger size has to beat the best smaller one by min_gain to be chosen
+		best_size = None
+		for size in sorted(self.measurements):
+			if self.measurements[size] and (best_size is None or
+											self.throughput(size) > self.throughput(best_size) * (1 + self.min_gain)):
+				best_size = size
+		return best_size
+
+	def grow(self):
+		self.size = min(self.max_size, self.size * 2)
+		self.measurements[self.size] = []
+
+	def update(self, rows, elapsed):
+		if rows < self.size:
+			return
+		if elapsed > self.latency_ceiling:
+			self.measurements = {size: batches for size, batches in self.measurements.items() if size < self.size}
+			self.best_size = self.choose_best_size() or max(1, self.size // 2)
+			self.size = self.best_size
+			self.probe_interval = self.probe_interval * 2 if self.probing else self.probe_after
+			self.growing = self.probing = False
+			self.good_batches = 0
+			return
+		batches = self.measurements.setdefault(self.size, [])
+		batches.append((rows, elapsed))
+		del batches[:-self.window]
+		self.best_size = self.choose_best_size()
+		if self.growing or self.probing:
+			if self.best_size == self.size:
+				self.probe_interval = self.probe_after
+				self.growing = self.size < self.max_size
+				if self.growing:
+					self.grow()
+			else:
+				if self.probing:
+					self.probe_interval *= 2
+				self.growing = False
+				self.size = self.best_size
+			self.probing = False
+			self.good_batches = 0
+			return
+		# Holding: follow the best size if the held size has slowed down, and probe upward
+		# after enough good batches
+		self.size = self.best_size
+		self.good_batches += 1
+		if self.good_batches >= self.probe_interval and self.size < self.max_size:
+			self.grow()
+			self.probing = True
+			self.good_batches = 0
+
+
+def parse_and_query_batched(input_file, output_file, url, batch_size, sizer=None):
+	# Sends `batch_size` affiliations per request, or a size chosen by `sizer` when adaptive.
+	# Returns timers for amortized per-row time and per-batch latency, and the batch log,
+	# covering the batches written if the run fails part way.
+	timed = LoopTimerContext()
+	batch_timed = LoopTimerContext()
+	batches = []
+	try:
+		with open(input_file, 'r+', encoding='utf-8-sig') as f_in, open(output_file, 'w', newline='') as f_out:
+			reader = csv.DictReader(f_in)
+			writer = csv.writer(f_out)
+			writer.writerow(
+				reader.fieldnames + ["predicted_ror_id"])
+			while True:
+				size = sizer.size if sizer else batch_size
+				chunk = list(itertools.islice(reader, size))
+				if not chunk:
+					break
+				affiliations = [row['affiliation'] for row in chunk]
+				start = time.perf_counter()
+				try:
+					predicted_ror_ids = openalex_predictions(affiliations, url)
+				except Exception as e:
+					logging.error(f'Error for batch of {len(chunk)} starting with: {affiliations[0]} - {e}')
+					predicted_ror_ids = [None] * len(chunk)
+				elapsed = time.perf_counter() - start
+				batch_timed.record(elapsed)
+				for _ in chunk:
+					timed.record(elapsed / len(chunk))
+				batches.append((len(chunk), elapsed))
+				if sizer:
+					sizer.update(len(chunk), elapsed)
+				for row, predicted_ror_id in zip(chunk, predicted_ror_ids):
+					writer.writerow(list(row.values()) + [predicted_ror_id])
+	except Exception as e:
+		logging.error(f'Error in parse_and_query_batched: {e}')
+	return timed, batch_timed, batches
+
+
+class EndpointRouter():
+	# Picks an endpoint per request, either in turn or the one with the fewest requests
+	# in flight, and keeps per-endpoint request latencies.
+	def __init__(self, urls, routing):
+		self.urls = urls
+		self.routing = routing
+		self.outstanding = [0] * len(urls)
+		self.rows = [0] * len(urls)
+		self.errors = [0] * len(urls)
+		self.timers = [LoopTimerContext() for _ in urls]
+		self.next_index = 0
+		self.lock = threading.Lock()
+
+	def acquire(self):
+		with self.lock:
+			if self.routing == 'least_outstanding':
+				index = min(range(len(self.urls)), key=lambda i: (self.outstanding[i], (i - self.next_index) % len(self.urls)))
+			else:
+				index = self.next_index
+			self.next_index = (index + 1) % len(self.urls)
+			self.outstanding[index] += 1
+			return index
+
+	def release(self, index, rows, elapsed, error=False):
+		with self.lock:
+			self.outstanding[index] -= 1
+			self.rows[index] += rows
+			self.timers[index].record(elapsed)
+			if error:
+				self.errors[index] += 1
+
+
+def routed_predictions(router, affiliations):
+	index = router.acquire()
+	start = time.perf_counter()
+	try:
+		predicted_ror_ids = openalex_predictions(affiliations, router.urls[index])
+		error = False
+	except Exception as e:
+		logging.error(f'Error from {router.urls[index]} for batch of {len(affiliations)} starting with: {affiliations[0]} - {e}')
+		predicted_ror_ids = [None] * len(affiliations)
+		error = True
+	elapsed = time.perf_counter() - start
+	router.release(index, len(affiliations), elapsed, error)
+	return predicted_ror_ids, elapsed
+
+
+def parse_and_query_concurrent(input_file, output_file, router, batch_size, workers):
+	# `workers` threads keep requests in flight across the endpoints. Batches are written in
+	# input order as the oldest completes, with at most a few batches per worker pending.
+	# If the run fails part way, the timer and wall time cover the batches written.
+	timed = LoopTimerContext()
+	start = time.perf_counter()
+	try:
+		SESSION.mount('http://', HTTPAdapter(pool_connections=len(router.urls), pool_maxsize=workers))
+		with open(input_file, 'r+', encoding='utf-8-sig') as f_in, open(output_file, 'w', newline='') as f_out, \
+				ThreadPoolExecutor(max_workers=workers) as executor:
+			reader = csv.DictReader(f_in)
+			writer = csv.writer(f_out)
+			writer.writerow(
+				reader.fieldnames + ["predicted_ror_id"])
+			pending = deque()
+
+			def write_oldest():
+				chunk, future = pending.popleft()
+				predicted_ror_ids, elapsed = future.result()
+				for row, predicted_ror_id in zip(chunk, predicted_ror_ids):
+					timed.record(elapsed / len(chunk))
+					writer.writerow(list(row.values()) + [predicted_ror_id])
+
+			while True:
+				chunk = list(itertools.islice(reader, batch_size))
+				if not chunk:
+					break
+				affiliations = [row['affiliation'] for row in chunk]
+				pending.append((chunk, executor.submit(routed_predictions, router, affiliations)))
+				if len(pending) >= workers * 2:
+					write_oldest()
+			while pending:
+				write_oldest()
+	except Exception as e:
+		logging.error(f'Error in parse_and_query_concurrent: {e}')
+	return timed, time.perf_counter() - start
+
+
+def write_endpoint_stats_to_csv(router, wall_time, filename="openalex_endpoint_stats.csv"):
+	with open(filename, 'w', newline='') as f_out:
+		writer = csv.writer(f_out)
+		writer.writerow(['Endpoint', 'Requests', 'Rows', 'Errors', 'Rows per Second', 'Average Latency',
+						 'P50 Latency', 'P90 Latency', 'P99 Latency'])
+		all_timer = LoopTimerContext()
+		for url, rows, errors, timer in zip(router.urls, router.rows, router.errors, router.timers):
+			all_timer.execution_times.extend(timer.execution_times)
+			write_endpoint_row(writer, url, timer, rows, errors, wall_time)
+		write_endpoint_row(writer, 'all', all_timer, sum(router.rows), sum(router.errors), wall_time)
+
+
+def write_endpoint_row(writer, endpoint, timer, rows, errors, wall_time):
+	if not timer.execution_times:
+		writer.writerow([endpoint, 0, 0, 0, '', '', '', '', ''])
+		return
+	percentiles = timer.get_percentiles((50, 90, 99))
+	writer.writerow([endpoint, len(timer.execution_times), rows, errors, f'{rows / wall_time:.2f}',
+					 f"{timer.get_stats()['average']:.6f}", f'{percentiles[50]:.6f}',
+					 f'{percentiles[90]:.6f}', f'{percentiles[99]:.6f}'])
+
+
+def write_batches_to_csv(batches, filename="openalex_batch_stats.csv"):
+	with open(filename, 'w', newline='') as f_out:
+		writer = csv.writer(f_out)
+		writer.writerow(['Batch', 'Rows', 'Seconds', 'Rows per Second'])
+		for i, (rows, elapsed) in enumerate(batches, 1):
+			writer.writerow([i, rows, f'{elapsed:.6f}', f'{rows / elapsed:.2f}'])
+
+
 def parse_arguments():
 	parser = argparse.ArgumentParser(
 		description='Return OpenAlex affiliation service matches for a given CSV file.')
 	parser.add_argument('-i', '--input', help='Input CSV file', required=True)
 	parser.add_argument('-o', '--output', help='Output CSV file', default='openalex_results.csv')
+	parser.add_argument('-u', '--url', help='URL of the OpenAlex model server invocations endpoint', default=DEFAULT_URL)
+	parser.add_argument('-b', '--batch_size', help='Number of affiliations to send per request (the initial size in adaptive mode)', type=int, default=1)
+	parser.add_argument('-a', '--adaptive', help='Tune the batch size for throughput while keeping each request under --latency_ceiling', action='store_true')
+	parser.add_argument('--max_batch_size', help='Largest batch size tried in adaptive mode', type=int, default=1024)
+	parser.add_argument('--latency_ceiling', help='Maximum seconds per request in adaptive mode', type=float, default=1.0)
+	parser.add_argument('--probe_after', help='Good batches at the held size before a larger size is tried again in adaptive mode', type=int, default=20)
+	parser.add_argument('-e', '--endpoints', help='One or more host:port (or URLs) of OpenAlex model servers to spread requests over', nargs='+', default=None)
+	parser.add_argument('-w', '--workers', help='Number of concurrent requests', type=int, default=1)
+	parser.add_argument('--routing', help='How requests are spread over endpoints', choices=['round_robin', 'least_outstanding'], default='round_robin')
 	return parser.parse_args()
 
 
 def main():
 	args = parse_arguments()
-	timed = parse_and_query(args.input, args.output)
+	if args.endpoints or args.workers > 1:
+		urls = [endpoint if endpoint.startswith('http') else f'http://{endpoint}/invocations'
+				for endpoint in args.endpoints] if args.endpoints else [args.url]
+		router = EndpointRouter(urls, args.routing)
+		timed, wall_time = parse_and_query_concurrent(args.input, args.output, router, args.batch_size, args.workers)
+		write_endpoint_stats_to_csv(router, wall_time)
+	elif args.batch_size > 1 or args.adaptive:
+		sizer = AdaptiveBatchSize(args.batch_size, args.max_batch_size, args.latency_ceiling,
+								  probe_after=args.probe_after) if args.adaptive else None
+		timed, batch_timed, batches = parse_and_query_batched(args.input, args.output, args.url, args.batch_size, sizer)
+		if batch_timed.execution_times:
+			batch_timed.write_stats_to_csv("openalex_batch_timing_stats.csv")
+		write_batches_to_csv(batches)
+		if sizer and batches:
+			print(f'Best batch size {sizer.best_size} ({sizer.best_throughput:.1f} rows/s measured at that size)')
+	else:
+		timed = parse_and_query(args.input, args.output, args.url)
+	if not timed or not timed.execution_times:
+		print("No affiliations were matched; see the log for errors")
+		return
 	timed.write_stats_to_csv("openalex_timing_stats.csv")
 
 
@@ -1,10 +1,14 @@
 import csv
+import time
+import asyncio
 import argparse
 import logging
-import requests
+from collections import deque
 from datetime import datetime
 from timer import LoopTimerContext
+from ror_client import add_client_arguments, client_from_args, get_chosen_result
 
+ROR_CLIENT = None
 now = datetime.now()
 script_start = now.strftime("%Y%m%d_%H%M%S")
 logging.basicConfig(filename=f'{script_start}_ror-affiliation_test.log', level=logging.ERROR, format='%(asctime)s %(levelname)s %(message)s')
@@ -13,18 +17,8 @@ logging.basicConfig(filename=f'{script_start}_ror-affiliation_test.log', level=l
 def query_affiliation(affiliation):
 	chosen_result = None
 	try:
-		url = "https://api.ror.org/organizations"
-		params = {"affiliation": affiliation}
-		r = requests.get(url, params=params)
-		api_response = r.json()
-		results = api_response['items']
-		if results:
-			for result in results:
-				if result['chosen']:
-					chosen_id = result['organization']['id']
-					score = result['score']
-					chosen_result = chosen_id, score
-					break
+		results = ROR_CLIENT.query(affiliation)
+		chosen_result = get_chosen_result(results)
 	except Exception as e:
 		logging.error(f'Error for query: {affiliation} - {e}')
 	return chosen_result
@@ -53,18 +47,91 @@ def parse_and_query(input_file, output_file):
 		logging.error(f'Error in parse_and_query: {e}')
 
 
+async def timed_query_affiliation_async(client, semaphore, affiliation, timed):
+	async with semaphore:
+		start = time.perf_counter()
+		chosen_result = None
+		try:
+			results = await client.query(affiliation)
+			chosen_result = get_chosen_result(results)
+		except Exception as e:
+			logging.error(f'Error for query: {affiliation} - {e}')
+		# Per-request latency, excluding time spent waiting for a free slot
+		timed.record(time.perf_counter() - start)
+	return chosen_result
+
+
+async def parse_and_query_async(input_file, output_file, client, concurrency):
+	# Rows are streamed in and queried with at most `concurrency` requests in flight. Pending
+	# rows are kept in input order, so results are written in order as the oldest completes,
+	# and no more than a few times `concurrency` rows are held in memory. If the run fails
+	# part way, queries still pending are cancelled and the timer covers those completed.
+	timed = LoopTimerContext()
+	pending = deque()
+	try:
+		semaphore = asyncio.Semaphore(concurrency)
+		max_pending = concurrency * 4
+		with open(input_file, 'r+', encoding='utf-8-sig') as f_in, open(output_file, 'w') as f_out:
+			reader = csv.DictReader(f_in)
+			fieldnames = reader.fieldnames + ["predicted_ror_id", "prediction_score"]
+			writer = csv.DictWriter(f_out, fieldnames=fieldnames)
+			writer.writeheader()
+
+			async def write_oldest():
+				row, task = pending.popleft()
+				chosen_result = await task
+				predicted_id, prediction_score = chosen_result if chosen_result else (None, None)
+				row.update({
+					"predicted_ror_id": predicted_id,
+					"prediction_score": prediction_score
+				})
+				writer.writerow(row)
+
+			for row in reader:
+				task = asyncio.create_task(timed_query_affiliation_async(client, semaphore, row['affiliation'], timed))
+				pending.append((row, task))
+				if len(pending) >= max_pending:
+					await write_oldest()
+			while pending:
+				await write_oldest()
+	except Exception as e:
+		logging.error(f'Error in parse_and_query_async: {e}')
+		for _, task in pending:
+			task.cancel()
+	return timed
+
+
+async def run_async(args):
+	async with client_from_args(args, pool_size=args.concurrency, use_async=True) as client:
+		timed = await parse_and_query_async(args.input, args.output, client, args.concurrency)
+	return timed, client.stats
+
+
 def parse_arguments():
 	parser = argparse.ArgumentParser(
 		description='Return ROR affiliation matches for a given CSV file.')
 	parser.add_argument('-i', '--input', help='Input CSV file', required=True)
 	parser.add_argument('-o', '--output', help='Output CSV file',
 						default='ror-affiliation_results.csv')
+	parser.add_argument('--async', dest='use_async', help='Query the API concurrently with asyncio, writing results in input order', action='store_true')
+	parser.add_argument('--concurrency', help='Maximum number of concurrent ROR affiliation API requests in async mode', type=int, default=10)
+	add_client_arguments(parser)
 	return parser.parse_args()
 
 
 def main():
+	global ROR_CLIENT
 	args = parse_arguments()
-	timed = parse_and_query(args.input, args.output)
+	if args.use_async:
+		timed, api_stats = asyncio.run(run_async(args))
+	else:
+		ROR_CLIENT = client_from_args(args)
+		timed = parse_and_query(args.input, args.output)
+		api_stats = ROR_CLIENT.stats
+	api_stats.write_stats_to_csv("ror_affiliation_api_stats.csv")
+	if not timed or not timed.execution_times:
+		print("No affiliations were matched; see the log for errors")
+		return
 	timed.write_stats_to_csv("ror_affiliation_timing_stats.csv")
 
 
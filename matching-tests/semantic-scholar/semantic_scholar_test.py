@@ -1,17 +1,119 @@
+import time
+# Taken before the remaining imports so the reported startup time includes them
+PROCESS_START = time.perf_counter()
+import gc
+import os
 import csv
+import pickle
 import argparse
 import logging
 from s2aff import S2AFF
+from s2aff.consts import PATHS
 from s2aff.ror import RORIndex
 from s2aff.model import NERPredictor, PairwiseRORLightGBMReranker
+from timer import LoopTimerContext, read_chunks
 
-NERMODEL = NERPredictor(use_cuda=False)
-RORINDEX = RORIndex()
-PAIRWISE_MODEL = PairwiseRORLightGBMReranker(RORINDEX)
-PREDICTOR = S2AFF(NERMODEL, RORINDEX, PAIRWISE_MODEL)
+# Built in main, so the ROR index can be restored from a snapshot
+NERMODEL = None
+RORINDEX = None
+PAIRWISE_MODEL = None
+PREDICTOR = None
 
 
-def parse_and_query(input_file, output_file):
+def get_snapshot_path(snapshot_dir, ror_data_path):
+    # Snapshots are keyed by the ROR dump file name, which carries the dump version, and
+    # its size, so a new or edited dump is never served from a stale snapshot
+    version = os.path.splitext(os.path.basename(ror_data_path))[0]
+    size = os.path.getsize(ror_data_path)
+    return os.path.join(snapshot_dir, f'ror_index_{version}_{size}.pickle')
+
+
+def load_ror_index(snapshot_dir, rebuild=False):
+    # Restores RORIndex from a pickled snapshot of its attributes if one exists for the
+    # current dump, otherwise builds it and saves a snapshot. Returns the index and
+    # whether it came from a snapshot.
+    snapshot_path = get_snapshot_path(snapshot_dir, PATHS['ror_data']) if snapshot_dir else None
+    if snapshot_path and os.path.exists(snapshot_path) and not rebuild:
+        # Unpickling millions of small objects is much faster without the cyclic collector
+        gc.disable()
+        try:
+            with open(snapshot_path, 'rb') as f_in:
+                attributes = pickle.load(f_in)
+            ror_index = RORIndex.__new__(RORIndex)
+            ror_index.__dict__.update(attributes)
+            return ror_index, True
+        except Exception as e:
+            logging.error(f'Error loading ROR index snapshot {snapshot_path}, rebuilding: {e}')
+        finally:
+            gc.enable()
+    ror_index = RORIndex()
+    if snapshot_path:
+        try:
+            os.makedirs(snapshot_dir, exist_ok=True)
+            temp_path = f'{snapshot_path}.tmp'
+            with open(temp_path, 'wb') as f_out:
+                pickle.dump(ror_index.__dict__, f_out, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(temp_path, snapshot_path)
+        except Exception as e:
+            logging.error(f'Error saving ROR index snapshot {snapshot_path}: {e}')
+    return ror_index, False
+
+
+def load_models(use_cuda, snapshot_dir, rebuild_snapshot):
+    global NERMODEL, RORINDEX, PAIRWISE_MODEL, PREDICTOR
+    startup_stats = {}
+    start = time.perf_counter()
+    NERMODEL = NERPredictor(use_cuda=use_cuda)
+    startup_stats['ner_load_time'] = time.perf_counter() - start
+    start = time.perf_counter()
+    RORINDEX, from_snapshot = load_ror_index(snapshot_dir, rebuild_snapshot)
+    startup_stats['ror_index_load_time'] = time.perf_counter() - start
+    startup_stats['ror_index_source'] = 'snapshot' if from_snapshot else 'built'
+    start = time.perf_counter()
+    PAIRWISE_MODEL = PairwiseRORLightGBMReranker(RORINDEX)
+    startup_stats['reranker_load_time'] = time.perf_counter() - start
+    PREDICTOR = S2AFF(NERMODEL, RORINDEX, PAIRWISE_MODEL)
+    startup_stats['startup_time'] = time.perf_counter() - PROCESS_START
+    return startup_stats
+
+
+def write_startup_stats_to_csv(startup_stats, filename="s2aff_startup_stats.csv"):
+    with open(filename, 'w', newline='') as f_out:
+        writer = csv.writer(f_out)
+        writer.writerow(['Metric', 'Value'])
+        for metric, value in startup_stats.items():
+            writer.writerow([metric, f'{value:.6f}' if isinstance(value, float) else value])
+
+
+def instrument(obj, method_name, timer):
+    # Shadows the bound method with a timed wrapper on this instance, so the calls S2AFF
+    # makes internally are timed without changing S2AFF itself
+    method = getattr(obj, method_name)
+
+    def timed_method(*args, **kwargs):
+        with timer:
+            return method(*args, **kwargs)
+    setattr(obj, method_name, timed_method)
+
+
+def instrument_stages():
+    # NER runs once per chunk, retrieval once per affiliation and reranking once per
+    # affiliation with candidates
+    stage_timers = {
+        'ner': LoopTimerContext(),
+        'retrieval': LoopTimerContext(),
+        'reranking': LoopTimerContext(),
+    }
+    instrument(NERMODEL, 'predict', stage_timers['ner'])
+    instrument(RORINDEX, 'get_candidates_from_main_affiliation', stage_timers['retrieval'])
+    instrument(PAIRWISE_MODEL, 'predict', stage_timers['reranking'])
+    return stage_timers
+
+
+def parse_and_query(input_file, output_file, batch_size):
+    # Returns the timers even if the run fails part way, so stats cover the rows written
+    timed = LoopTimerContext()
+    chunk_timed = LoopTimerContext()
     try:
         with open(input_file, 'r', encoding='utf-8-sig') as f_in, open(output_file, 'w', newline='', encoding='utf-8') as f_out:
             reader = csv.DictReader(f_in)
@@ -19,23 +121,49 @@ def parse_and_query(input_file, output_file):
                 ["predicted_ror_id", "prediction_score"]
             writer = csv.DictWriter(f_out, fieldnames=fieldnames)
             writer.writeheader()
-            for row in reader:
-                affiliation = row['affiliation']
-                print(affiliation)
-                prediction = PREDICTOR.predict([affiliation])
-                if prediction:
-                    prediction_results = prediction[0]
-                    predicted_ror_id = prediction_results['stage2_candidates'][0]
-                    prediction_score = prediction_results['stage2_scores'][0]
+            for chunk in read_chunks(reader, batch_size):
+                affiliations = [row['affiliation'] for row in chunk]
+                start = time.perf_counter()
+                try:
+                    predictions = PREDICTOR.predict(affiliations)
+                except Exception as e:
+                    logging.error(f'Error for chunk starting with: {affiliations[0]} - {e}')
+                    predictions = [None] * len(chunk)
+                elapsed = time.perf_counter() - start
+                chunk_timed.record(elapsed)
+                for row, prediction_results in zip(chunk, predictions):
+                    timed.record(elapsed / len(chunk))
+                    predicted_ror_id, prediction_score = None, None
+                    # S2AFF returns no candidates for affiliations it can't match
+                    if prediction_results and prediction_results['stage2_candidates']:
+                        predicted_ror_id = prediction_results['stage2_candidates'][0]
+                        prediction_score = prediction_results['stage2_scores'][0]
                     row.update({
                         "predicted_ror_id": predicted_ror_id,
                         "prediction_score": prediction_score
                     })
                     writer.writerow(row)
-                    print(
-                        prediction_results['top_candidate_display_name'], predicted_ror_id, prediction_score)
     except Exception as e:
         logging.error(f'Error in parse_and_query: {e}')
+    return timed, chunk_timed
+
+
+def write_stage_stats_to_csv(stage_timers, chunk_timed, filename="s2aff_stage_timing_stats.csv"):
+    total_time = sum(chunk_timed.execution_times)
+    with open(filename, 'w', newline='') as f_out:
+        writer = csv.writer(f_out)
+        writer.writerow(['Stage', 'Calls', 'Total Time', 'Share of Prediction Time',
+                         'Average Time', 'P50 Time', 'P90 Time', 'P99 Time'])
+        for stage, timer in list(stage_timers.items()) + [('prediction', chunk_timed)]:
+            if not timer.execution_times:
+                writer.writerow([stage, 0, '', '', '', '', '', ''])
+                continue
+            stage_time = sum(timer.execution_times)
+            percentiles = timer.get_percentiles((50, 90, 99))
+            writer.writerow([stage, len(timer.execution_times), f'{stage_time:.6f}',
+                             f'{stage_time / total_time:.4f}' if total_time else '',
+                             f"{timer.get_stats()['average']:.6f}", f'{percentiles[50]:.6f}',
+                             f'{percentiles[90]:.6f}', f'{percentiles[99]:.6f}'])
 
 
 def parse_arguments():
@@ -45,13 +173,30 @@ def parse_arguments():
     parser.add_argument(
         '-o', '--output', default="S2AFF_results.csv", help="Output CSV file")
     parser.add_argument(
-        '-c', '--cuda', choices=[True, False], default=False, help="Use CUDA (True or False)")
+        '-c', '--cuda', choices=['True', 'False'], default='False', help="Use CUDA (True or False)")
+    parser.add_argument(
+        '-b', '--batch_size', type=int, default=100, help="Number of affiliations passed to S2AFF per predict call")
+    parser.add_argument(
+        '-s', '--snapshot_dir', default='ror_index_snapshots', help="Directory for ROR index snapshots")
+    parser.add_argument(
+        '--no_snapshot', action='store_true', help="Always build the ROR index and do not save a snapshot")
+    parser.add_argument(
+        '--rebuild_snapshot', action='store_true', help="Build the ROR index and overwrite its snapshot")
     return parser.parse_args()
 
 
 def main():
     args = parse_arguments()
-    parse_and_query(args.input, args.output)
+    snapshot_dir = None if args.no_snapshot else args.snapshot_dir
+    startup_stats = load_models(args.cuda == 'True', snapshot_dir, args.rebuild_snapshot)
+    write_startup_stats_to_csv(startup_stats)
+    stage_timers = instrument_stages()
+    timed, chunk_timed = parse_and_query(args.input, args.output, args.batch_size)
+    if not timed.execution_times:
+        print("No affiliations were matched; see the log for errors")
+        return
+    timed.write_stats_to_csv("s2aff_timing_stats.csv")
+    write_stage_stats_to_csv(stage_timers, chunk_timed)
 
 
 if __name__ == "__main__":
@@ -3,27 +3,13 @@ import csv
 import argparse
 import torch
 from transformers import BertTokenizerFast, BertForTokenClassification
-from unidecode import unidecode
-from gensim.parsing.preprocessing import (
-    preprocess_string,
-    strip_tags,
-    strip_punctuation,
-    strip_multiple_whitespaces,
-)
+from normalizer import normalize
 
 MAX_LEN = 128
 
 
 def normalize_and_split(affiliation):
-    custom_filters = [
-        lambda x: x.lower(),
-        strip_tags,
-        strip_punctuation,
-        strip_multiple_whitespaces,
-    ]
-    affiliation = unidecode(
-        " ".join(preprocess_string(affiliation, custom_filters)))
-    return affiliation.split()
+    return normalize(affiliation).split()
 
 
 def load_model(model_path):
@@ -2,27 +2,22 @@ import csv
 import time
 import argparse
 import logging
-import requests
 from datetime import datetime
 from predictor import Predictor
+from ror_client import add_client_arguments, client_from_args, get_chosen_result
 
 now = datetime.now()
 script_start = now.strftime("%Y%m%d_%H%M%S")
 logging.basicConfig(filename=f'{script_start}_concurrence_check.log', level=logging.ERROR,
                     format='%(asctime)s %(levelname)s %(message)s')
 PREDICTOR = Predictor('models/')
+ROR_CLIENT = None
 
 
 def query_affiliation(affiliation):
     try:
-        url = "https://api.ror.org/organizations"
-        params = {"affiliation": affiliation}
-        response = requests.get(url, params=params)
-        results = response.json()
-        for result in results["items"]:
-            if result["chosen"]:
-                return result['organization']['id'], result['score']
-        return None, None
+        results = ROR_CLIENT.query(affiliation)
+        return get_chosen_result(results) or (None, None)
     except Exception as e:
         logging.error(f'Error for query: {affiliation} - {e}')
         return None, None
@@ -65,12 +60,16 @@ def parse_arguments():
         '-o', '--output', help='Output CSV file', default='concur_results.csv')
     parser.add_argument(
         '-m', '--min_probability', help='Minimum probability for the fasttext predictor', type=float, default=0.8)
+    add_client_arguments(parser)
     return parser.parse_args()
 
 
 def main():
+    global ROR_CLIENT
     args = parse_arguments()
+    ROR_CLIENT = client_from_args(args)
     parse_and_query(args.input, args.output, args.min_probability)
+    ROR_CLIENT.stats.write_stats_to_csv("concurrence_check_api_stats.csv")
 
 
 if __name__ == '__main__':
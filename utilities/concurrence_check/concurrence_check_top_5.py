@@ -2,31 +2,29 @@ import csv
 import time
 import argparse
 import logging
-import requests
 from datetime import datetime
 from predictor import Predictor
+from ror_client import add_client_arguments, client_from_args
 
 now = datetime.now()
 script_start = now.strftime('%Y%m%d_%H%M%S')
 logging.basicConfig(filename=f'{script_start}_concurrence_check_top_5.log', level=logging.ERROR,
                     format='%(asctime)s %(levelname)s %(message)s')
 PREDICTOR = Predictor('models/')
+ROR_CLIENT = None
 
 
 def query_affiliation(affiliation):
     try:
         match_dict = {'chosen_id': None, 'top_results': None,
                       'score': None, 'top_5_scores': []}
-        url = "https://api.ror.org/organizations"
-        params = {"affiliation": affiliation}
-        response = requests.get(url, params=params)
-        results = response.json()
-        extent_results = len(results['items'])
+        results = ROR_CLIENT.query(affiliation, require_complete=True)
+        extent_results = len(results)
         if extent_results == 0:
             return match_dict
         else:
             top_results = []
-            for i, result in enumerate(results['items']):
+            for i, result in enumerate(results):
                 if i < 5:
                     top_results.append(result['organization']['id'])
                     match_dict['top_5_scores'].append(result['score'])
@@ -89,12 +87,16 @@ def parse_arguments():
         '-o', '--output', help='Output CSV file', default='concur_results_top_5.csv')
     parser.add_argument(
         '-m', '--min_probability', help='Minimum probability for the fasttext predictor', type=float, default=0.5)
+    add_client_arguments(parser)
     return parser.parse_args()
 
 
 def main():
+    global ROR_CLIENT
     args = parse_arguments()
+    ROR_CLIENT = client_from_args(args)
     parse_and_query(args.input, args.output, args.min_probability)
+    ROR_CLIENT.stats.write_stats_to_csv("concurrence_check_top_5_api_stats.csv")
 
 
 if __name__ == '__main__':
@@ -7,8 +7,7 @@ import statistics
 import logging
 import unicodedata
 from datetime import datetime
-from unidecode import unidecode
-from gensim.parsing.preprocessing import preprocess_string, strip_tags, strip_multiple_whitespaces, strip_punctuation
+from normalizer import normalize_name
 
 
 def preprocess_primary_name(name):
@@ -23,9 +22,7 @@ def check_latin_chars(s):
 
 
 def preprocess_text(text):
-    text = re.sub(r'[.,\']', ' ', text)
-    custom_filters = [lambda x: x, strip_tags, strip_multiple_whitespaces]
-    return unidecode(' '.join(preprocess_string(text, custom_filters))).lower()
+    return normalize_name(text)
 
 
 def get_max_length(record):
@@ -6,8 +6,7 @@ import pickle
 import itertools
 import unicodedata
 from rapidfuzz import fuzz
-from unidecode import unidecode
-from gensim.parsing.preprocessing import preprocess_string, strip_tags, strip_multiple_whitespaces, strip_punctuation
+from normalizer import normalize_name
 
 
 def load_CLDR_data(cldr_file):
@@ -28,9 +27,7 @@ def check_latin_chars(s):
 
 
 def preprocess_text(text):
-	text = re.sub(r'[.,\']', ' ', text)
-	custom_filters = [lambda x: x, strip_tags, strip_multiple_whitespaces]
-	return unidecode(' '.join(preprocess_string(text, custom_filters))).lower()
+	return normalize_name(text)
 
 
 def get_all_names(record):
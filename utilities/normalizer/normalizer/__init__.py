@@ -0,0 +1 @@
+from .normalizer import *
\ No newline at end of file
@@ -0,0 +1,67 @@
+import re
+import string
+from unidecode import unidecode
+
+__all__ = ['normalize', 'normalize_batch', 'normalize_name', 'normalize_name_batch', 'transliterate']
+
+RE_TAGS = re.compile(r"<([^>]+)>")
+PUNCTUATION_TO_SPACE = str.maketrans(string.punctuation, ' ' * len(string.punctuation))
+NAME_PUNCTUATION_TO_SPACE = str.maketrans(".,'", '   ')
+
+
+class TransliterationTable(dict):
+    # unidecode transliterates one code point at a time, so its output for a string is
+    # the concatenation of its output for each character. Caching that per code point
+    # lets str.translate do the whole string in a single pass.
+    def __missing__(self, codepoint):
+        transliterated = unidecode(chr(codepoint))
+        self[codepoint] = transliterated
+        return transliterated
+
+
+TRANSLITERATION_TABLE = TransliterationTable()
+
+
+def transliterate(text):
+    if text.isascii():
+        return text
+    return text.translate(TRANSLITERATION_TABLE)
+
+
+def strip_tags(text):
+    if '<' not in text:
+        return text
+    return RE_TAGS.sub('', text)
+
+
+def normalize(text):
+    # Same output as unidecode(' '.join(preprocess_string(text, [lambda x: x.lower(),
+    # strip_tags, strip_punctuation, strip_multiple_whitespaces]))). Splitting on
+    # whitespace and rejoining collapses both the whitespace and the runs of spaces
+    # left by punctuation.
+    text = strip_tags(text.lower()).translate(PUNCTUATION_TO_SPACE)
+    return transliterate(' '.join(text.split()))
+
+
+def normalize_name(text):
+    # Same output as unidecode(' '.join(preprocess_string(re.sub(r'[.,\']', ' ', text),
+    # [lambda x: x, strip_tags, strip_multiple_whitespaces]))).lower(), the chain used
+    # for ROR names and CLDR locations in ner_indexes and parse_cldr
+    text = strip_tags(text.translate(NAME_PUNCTUATION_TO_SPACE))
+    return transliterate(' '.join(text.split())).lower()
+
+
+def normalize_batch(texts):
+    normalized = {}
+    for text in texts:
+        if text not in normalized:
+            normalized[text] = normalize(text)
+    return [normalized[text] for text in texts]
+
+
+def normalize_name_batch(texts):
+    normalized = {}
+    for text in texts:
+        if text not in normalized:
+            normalized[text] = normalize_name(text)
+    return [normalized[text] for text in texts]
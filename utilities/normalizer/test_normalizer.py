@@ -0,0 +1,68 @@
+import re
+import csv
+import glob
+import os
+import pytest
+
+pytest.importorskip('unidecode')
+gensim_preprocessing = pytest.importorskip('gensim.parsing.preprocessing')
+from unidecode import unidecode
+from normalizer import normalize, normalize_batch, normalize_name, normalize_name_batch
+
+TEST_DATA_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'test_data')
+
+SAMPLES = [
+    '',
+    '   ',
+    'University of Oxford',
+    'Département de Physique, <i>Université</i> Paris-Saclay',
+    "King's College London",
+    'Dept. of Chemistry,\tUniv.  of\nCambridge, U.K.',
+    'Institut für Physik (IfP), Universität Zürich',
+    '<sup>1</sup>Peking University &amp; 北京大学',
+    'Москва, Россия — МГУ им. М.В. Ломоносова',
+    'Universidad Autónoma de México (UNAM); C.P. 04510',
+    'Tokyo 東京大学 ☃ 🎓 100% #1',
+    '<a href="x">link</a> <unclosed tag',
+    'ÆØÅ æøå ß Œ œ ł Ł ı İ',
+    'a b c​d',
+]
+
+
+def gensim_normalize(text):
+    # Chain the fasttext predictors and NER inference used before the normalizer library
+    custom_filters = [lambda x: x.lower(), gensim_preprocessing.strip_tags,
+                      gensim_preprocessing.strip_punctuation, gensim_preprocessing.strip_multiple_whitespaces]
+    return unidecode(' '.join(gensim_preprocessing.preprocess_string(text, custom_filters)))
+
+
+def gensim_normalize_name(text):
+    # Chain ner_indexes and parse_cldr used for ROR names and CLDR locations
+    text = re.sub(r'[.,\']', ' ', text)
+    custom_filters = [lambda x: x, gensim_preprocessing.strip_tags, gensim_preprocessing.strip_multiple_whitespaces]
+    return unidecode(' '.join(gensim_preprocessing.preprocess_string(text, custom_filters))).lower()
+
+
+def assert_byte_identical(values):
+    for value in values:
+        assert normalize(value).encode('utf-8') == gensim_normalize(value).encode('utf-8'), value
+        assert normalize_name(value).encode('utf-8') == gensim_normalize_name(value).encode('utf-8'), value
+
+
+def test_samples_match_gensim_chains():
+    assert_byte_identical(SAMPLES)
+
+
+def test_batches_match_single_values():
+    texts = SAMPLES + SAMPLES[::-1]
+    assert normalize_batch(texts) == [normalize(text) for text in texts]
+    assert normalize_name_batch(texts) == [normalize_name(text) for text in texts]
+
+
+@pytest.mark.parametrize('input_file', sorted(glob.glob(os.path.join(TEST_DATA_DIR, '**', '*.csv'), recursive=True)),
+                         ids=os.path.basename)
+def test_test_data_matches_gensim_chains(input_file):
+    # Every non-empty value in every column of the repository's test data
+    with open(input_file, 'r+', encoding='utf-8-sig') as f_in:
+        values = {value for row in csv.DictReader(f_in) for value in row.values() if isinstance(value, str) and value}
+    assert_byte_identical(values)
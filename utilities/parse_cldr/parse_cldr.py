@@ -5,8 +5,7 @@ import argparse
 import unicodedata
 from collections import defaultdict
 from bs4 import BeautifulSoup
-from unidecode import unidecode
-from gensim.parsing.preprocessing import preprocess_string, strip_tags, strip_multiple_whitespaces, strip_punctuation
+from normalizer import normalize_name
 
 
 def parse_xml(xml_content, field):
@@ -29,10 +28,10 @@ def check_latin_chars(s):
 
 
 def preprocess_text(text):
-    text = re.sub(r'[.,\']', ' ', text)
-    text = re.sub(r'\s\(.*\)', '', text)
-    custom_filters = [lambda x: x, strip_tags, strip_multiple_whitespaces]
-    return unidecode(' '.join(preprocess_string(text, custom_filters))).lower()
+    # Parentheticals are dropped whether they follow a space or one of the characters
+    # normalize_name turns into a space
+    text = re.sub(r'[\s.,\']\(.*\)', '', text)
+    return normalize_name(text)
 
 
 # Transform the ROR address code values to match the format in the CLDR XML files
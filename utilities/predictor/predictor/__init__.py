@@ -0,0 +1 @@
+from .predictor import *
\ No newline at end of file
@@ -0,0 +1,192 @@
+import os
+import re
+import json
+import fasttext
+import http.client
+from urllib.parse import urlparse
+from collections import OrderedDict
+from normalizer import normalize
+
+__all__ = ['LRUCache', 'Predictor', 'PredictorClient']
+
+# Suppress erroneous error message on loading model that Meta never fixed
+# https://github.com/facebookresearch/fastText/issues/1067
+fasttext.FastText.eprint = lambda x: None
+
+
+class LRUCache():
+	def __init__(self, max_size):
+		self.max_size = max_size
+		self.entries = OrderedDict()
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+
+	def get(self, key):
+		if key in self.entries:
+			self.entries.move_to_end(key)
+			self.hits += 1
+			return True, self.entries[key]
+		self.misses += 1
+		return False, None
+
+	def put(self, key, value):
+		self.entries[key] = value
+		self.entries.move_to_end(key)
+		if len(self.entries) > self.max_size:
+			self.entries.popitem(last=False)
+			self.evictions += 1
+
+	def get_stats(self):
+		return {
+			'size': len(self.entries),
+			'max_size': self.max_size,
+			'hits': self.hits,
+			'misses': self.misses,
+			'evictions': self.evictions,
+		}
+
+
+class Predictor():
+	def __init__(self, path_to_model, cache_size=100000, use_cache=True, model_file='model.bin'):
+		# model_file can be either a full precision (.bin) or quantized (.ftz) model
+		self.model = os.path.join(path_to_model, model_file)
+		self.classifier = fasttext.load_model(self.model)
+		# Raw strings that differ only in case, punctuation or markup collapse to the
+		# same normalized form, so predictions are cached on the normalized string
+		# and the raw string cache only saves the normalization itself
+		self.use_cache = use_cache and cache_size > 0
+		self.normalized_cache = LRUCache(cache_size)
+		self.prediction_cache = LRUCache(cache_size)
+
+	def preprocess_text(self, text):
+		if not self.use_cache:
+			return self._preprocess_text(text)
+		found, normalized = self.normalized_cache.get(text)
+		if not found:
+			normalized = self._preprocess_text(text)
+			self.normalized_cache.put(text, normalized)
+		return normalized
+
+	def _preprocess_text(self, text):
+		return normalize(text)
+
+	def predict_ror_id(self, affiliation, min_probability):
+		affiliation = self.preprocess_text(affiliation)
+		found, candidates = self._get_cached(affiliation, 1, min_probability)
+		if not found:
+			labels, probabilities = self.classifier.predict(affiliation, k=1, threshold=min_probability)
+			candidates = self._parse_candidates(labels, probabilities)
+			self._put_cached(affiliation, 1, min_probability, candidates)
+		return candidates[0] if candidates else (None, None)
+
+	def predict_ror_ids(self, list_of_affiliations, min_probability):
+		return [candidates[0] if candidates else (None, None)
+				for candidates in self._predict_batch(list_of_affiliations, 1, min_probability)]
+
+	def predict_top_k(self, affiliation, k, min_probability=0.0):
+		return self._predict_batch([affiliation], k, min_probability)[0]
+
+	def predict_top_k_batch(self, list_of_affiliations, k, min_probability=0.0):
+		return self._predict_batch(list_of_affiliations, k, min_probability)
+
+	def _predict_batch(self, list_of_affiliations, k, min_probability):
+		# For top-1, passing a list to fastText's predict classifies all lines in a
+		# single native call, avoiding the per-string Python overhead of predict_ror_id.
+		# Multi-line predict repeats the top-1 probability for every label when k > 1,
+		# so top-k predictions are made one unique string at a time.
+		if not list_of_affiliations:
+			return []
+		affiliations = [self.preprocess_text(affiliation) for affiliation in list_of_affiliations]
+		predictions = {}
+		for affiliation in affiliations:
+			if affiliation not in predictions:
+				found, candidates = self._get_cached(affiliation, k, min_probability)
+				if found:
+					predictions[affiliation] = candidates
+		uncached = list(dict.fromkeys(affiliation for affiliation in affiliations if affiliation not in predictions))
+		if uncached:
+			if k == 1:
+				all_labels, all_probabilities = self.classifier.predict(uncached, k=k, threshold=min_probability)
+			else:
+				all_labels, all_probabilities = zip(*[self.classifier.predict(affiliation, k=k, threshold=min_probability)
+													  for affiliation in uncached])
+			for affiliation, labels, probabilities in zip(uncached, all_labels, all_probabilities):
+				candidates = self._parse_candidates(labels, probabilities)
+				predictions[affiliation] = candidates
+				self._put_cached(affiliation, k, min_probability, candidates)
+		return [predictions[affiliation] for affiliation in affiliations]
+
+	def _get_cached(self, affiliation, k, min_probability):
+		if not self.use_cache:
+			return False, None
+		return self.prediction_cache.get((affiliation, k, min_probability))
+
+	def _put_cached(self, affiliation, k, min_probability, candidates):
+		if self.use_cache:
+			self.prediction_cache.put((affiliation, k, min_probability), candidates)
+
+	def _parse_candidates(self, labels, probabilities):
+		# Multi-line predict returns float32 probabilities, where single-line
+		# predict returns float64, so convert to keep the written scores identical
+		return [(re.sub('__label__','', label), float(probability))
+				for label, probability in zip(labels, probabilities)]
+
+	def get_cache_stats(self):
+		return {
+			'normalized': self.normalized_cache.get_stats(),
+			'prediction': self.prediction_cache.get_stats(),
+		}
+
+
+class PredictorClient():
+	# Drop-in replacement for Predictor that sends batches to a running matcher_daemon.py,
+	# so short jobs skip loading the model themselves
+	def __init__(self, server_url, timeout=60):
+		parsed_url = urlparse(server_url)
+		self.host = parsed_url.hostname
+		self.port = parsed_url.port or 80
+		self.timeout = timeout
+		self.use_cache = False
+		self.connection = None
+		self.connection_pid = None
+
+	def _request(self, method, path, payload=None):
+		# Connections are not shared across forked worker processes
+		if self.connection is None or self.connection_pid != os.getpid():
+			self.connection = http.client.HTTPConnection(self.host, self.port, timeout=self.timeout)
+			self.connection_pid = os.getpid()
+		# Sent as bytes so http.client writes headers and body in a single packet
+		body = json.dumps(payload).encode('utf-8') if payload is not None else None
+		headers = {'Content-Type': 'application/json'} if body else {}
+		try:
+			self.connection.request(method, path, body=body, headers=headers)
+			response = self.connection.getresponse()
+			response_body = response.read()
+		except (http.client.HTTPException, OSError):
+			self.connection.close()
+			self.connection = None
+			raise
+		if response.status != 200:
+			raise RuntimeError(f'Matcher server returned {response.status}: {response_body[:200]}')
+		return json.loads(response_body)
+
+	def predict_ror_id(self, affiliation, min_probability):
+		return self.predict_ror_ids([affiliation], min_probability)[0]
+
+	def predict_ror_ids(self, list_of_affiliations, min_probability):
+		return [candidates[0] if candidates else (None, None)
+				for candidates in self.predict_top_k_batch(list_of_affiliations, 1, min_probability)]
+
+	def predict_top_k(self, affiliation, k, min_probability=0.0):
+		return self.predict_top_k_batch([affiliation], k, min_probability)[0]
+
+	def predict_top_k_batch(self, list_of_affiliations, k, min_probability=0.0):
+		if not list_of_affiliations:
+			return []
+		response = self._request('POST', '/predict', {'affiliations': list_of_affiliations,
+													  'k': k, 'min_probability': min_probability})
+		return [[tuple(candidate) for candidate in candidates] for candidates in response['candidates']]
+
+	def get_server_stats(self):
+		return self._request('GET', '/stats')
\ No newline at end of file
@@ -0,0 +1,60 @@
+import re
+import pytest
+
+fasttext = pytest.importorskip('fasttext')
+pytest.importorskip('normalizer')
+from predictor import Predictor
+
+TRAINING_LINES = [
+	'__label__https://ror.org/052gg0110 university of oxford',
+	'__label__https://ror.org/052gg0110 department of physics university of oxford',
+	'__label__https://ror.org/013meh722 university of cambridge',
+	'__label__https://ror.org/013meh722 department of physics university of cambridge',
+	'__label__https://ror.org/03vek6s52 harvard university',
+	'__label__https://ror.org/03vek6s52 harvard medical school boston',
+	'__label__https://ror.org/042nb2s44 massachusetts institute of technology',
+	'__label__https://ror.org/042nb2s44 mit department of physics cambridge',
+]
+
+AFFILIATIONS = [
+	'University of Oxford',
+	'Dept. of Physics, University of Cambridge',
+	'Harvard Medical School, Boston',
+	'University of Oxford',
+	'MIT, Cambridge, MA',
+]
+
+
+@pytest.fixture(scope='module')
+def predictor(tmp_path_factory):
+	model_dir = tmp_path_factory.mktemp('model')
+	training_file = model_dir / 'train.txt'
+	training_file.write_text('\n'.join(TRAINING_LINES * 20) + '\n')
+	model = fasttext.train_supervised(str(training_file), epoch=25, lr=0.5, seed=0, thread=1, verbose=0)
+	model.save_model(str(model_dir / 'model.bin'))
+	return Predictor(str(model_dir))
+
+
+def single_line_top_k(predictor, affiliation, k):
+	labels, probabilities = predictor.classifier.predict(predictor.preprocess_text(affiliation), k=k, threshold=0.0)
+	return [(re.sub('__label__', '', label), float(probability)) for label, probability in zip(labels, probabilities)]
+
+
+@pytest.mark.parametrize('k', [1, 3])
+def test_batched_top_k_matches_single_line_predict(predictor, k):
+	expected = [single_line_top_k(predictor, affiliation, k) for affiliation in AFFILIATIONS]
+	# The second call is served from the prediction cache
+	for _ in range(2):
+		batched = predictor.predict_top_k_batch(AFFILIATIONS, k)
+		assert [[label for label, _ in candidates] for candidates in batched] == \
+			[[label for label, _ in candidates] for candidates in expected]
+		for candidates, expected_candidates in zip(batched, expected):
+			assert [score for _, score in candidates] == pytest.approx([score for _, score in expected_candidates], abs=1e-6)
+
+
+def test_batched_top_k_scores_are_per_label(predictor):
+	# Multi-line predict in fastText 0.9.2 repeats the top-1 probability for every label
+	for candidates in predictor.predict_top_k_batch(['Harvard Medical School, Boston', 'MIT, Cambridge, MA'], 3):
+		scores = [score for _, score in candidates]
+		assert scores == sorted(scores, reverse=True)
+		assert scores[0] > scores[-1]
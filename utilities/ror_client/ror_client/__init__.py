@@ -0,0 +1,3 @@
+from .client import *
+from .cache import *
+from .cli import *
\ No newline at end of file
@@ -0,0 +1,125 @@
+import csv
+import json
+import time
+import sqlite3
+import threading
+from .client import DEFAULT_BASE_URL
+
+__all__ = ['ResponseCache', 'normalize_cache_key', 'compact_items', 'expand_items']
+
+
+def normalize_cache_key(affiliation):
+    # Only whitespace is normalized. The affiliation service is sensitive to case and
+    # punctuation, so stronger normalization could return another string's results.
+    return ' '.join(affiliation.split())
+
+
+def compact_items(items):
+    return [[item['organization']['id'], item['organization'].get('name'), item['score'],
+             item['chosen'], item.get('matching_type')] for item in items]
+
+
+def expand_items(compact):
+    return [{'organization': {'id': org_id, 'name': name}, 'score': score,
+             'chosen': chosen, 'matching_type': matching_type}
+            for org_id, name, score, chosen, matching_type in compact]
+
+
+class ResponseCache:
+    # SQLite cache of ranked affiliation API results, keyed by affiliation string, the
+    # base URL of the API that answered and an API/version tag, so responses from a
+    # stand-in server are never served for the real API or the other way round. Entries
+    # warmed from results files only hold the chosen result, so they are marked
+    # incomplete and skipped when callers need every item.
+    def __init__(self, path, api_tag='v1', ttl=None, base_url=DEFAULT_BASE_URL):
+        self.api_tag = api_tag
+        self.base_url = base_url.rstrip('/')
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('PRAGMA synchronous=NORMAL')
+        self.create_table()
+
+    def create_table(self):
+        columns = [row[1] for row in self.connection.execute('PRAGMA table_info(responses)')]
+        if columns and 'base_url' not in columns:
+            # Files written before entries were keyed by base URL don't record which API
+            # answered. Their entries are kept under an empty base URL, which no client
+            # queries, so they are not served for either API.
+            self.connection.execute('BEGIN')
+            self.connection.execute('ALTER TABLE responses RENAME TO responses_unkeyed')
+        self.connection.execute('''CREATE TABLE IF NOT EXISTS responses (
+            affiliation TEXT NOT NULL,
+            base_url TEXT NOT NULL,
+            api_tag TEXT NOT NULL,
+            items TEXT NOT NULL,
+            complete INTEGER NOT NULL,
+            fetched_at REAL NOT NULL,
+            PRIMARY KEY (affiliation, base_url, api_tag))''')
+        if columns and 'base_url' not in columns:
+            self.connection.execute('''INSERT INTO responses SELECT affiliation, '', api_tag, items,
+                complete, fetched_at FROM responses_unkeyed''')
+            self.connection.execute('DROP TABLE responses_unkeyed')
+            self.connection.execute('COMMIT')
+
+    def get(self, affiliation, require_complete=False):
+        query = 'SELECT items FROM responses WHERE affiliation = ? AND base_url = ? AND api_tag = ?'
+        params = [normalize_cache_key(affiliation), self.base_url, self.api_tag]
+        if require_complete:
+            query += ' AND complete = 1'
+        if self.ttl:
+            query += ' AND fetched_at >= ?'
+            params.append(time.time() - self.ttl)
+        with self.lock:
+            row = self.connection.execute(query, params).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return expand_items(json.loads(row[0]))
+
+    def put(self, affiliation, items, complete=True):
+        with self.lock:
+            self.connection.execute('INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?)',
+                                    (normalize_cache_key(affiliation), self.base_url, self.api_tag,
+                                     json.dumps(compact_items(items)), int(complete), time.time()))
+
+    def warm_from_csv(self, results_file, id_column='predicted_ror_id', score_column='prediction_score',
+                      include_negatives=False):
+        # Loads the chosen results from a results file written by an affiliation API run.
+        # Existing entries, which may be complete, are left alone. Rows without a predicted
+        # ID are skipped unless include_negatives, since results files also leave the ID
+        # empty when the request failed, and caching those would turn transient errors
+        # into permanent "no match" answers.
+        rows = []
+        with open(results_file, 'r+', encoding='utf-8-sig') as f_in:
+            reader = csv.DictReader(f_in)
+            for row in reader:
+                items = []
+                if row[id_column]:
+                    items.append({'organization': {'id': row[id_column]},
+                                  'score': float(row[score_column]), 'chosen': True})
+                elif not include_negatives:
+                    continue
+                rows.append((normalize_cache_key(row['affiliation']), self.base_url, self.api_tag,
+                             json.dumps(compact_items(items)), 0, time.time()))
+        with self.lock:
+            before = self.connection.total_changes
+            self.connection.execute('BEGIN')
+            self.connection.executemany('INSERT OR IGNORE INTO responses VALUES (?, ?, ?, ?, ?, ?)', rows)
+            self.connection.execute('COMMIT')
+            return self.connection.total_changes - before
+
+    def purge_expired(self):
+        if not self.ttl:
+            return 0
+        with self.lock:
+            cursor = self.connection.execute('DELETE FROM responses WHERE fetched_at < ?',
+                                             (time.time() - self.ttl,))
+            return cursor.rowcount
+
+    def close(self):
+        self.connection.close()
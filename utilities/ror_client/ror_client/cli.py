@@ -0,0 +1,29 @@
+from .client import DEFAULT_BASE_URL, RORAffiliationClient, AsyncRORAffiliationClient
+from .cache import ResponseCache
+
+__all__ = ['add_client_arguments', 'client_from_args']
+
+
+def add_client_arguments(parser):
+    # Options shared by the scripts that query the ROR affiliation API
+    parser.add_argument('--base_url', help='Base URL of the ROR API, e.g. a local stand_in_server.py', default=DEFAULT_BASE_URL)
+    parser.add_argument('--timeout', help='Read timeout in seconds for ROR affiliation API requests', type=float, default=30)
+    parser.add_argument('--connect_timeout', help='Connect timeout in seconds for ROR affiliation API requests', type=float, default=3.05)
+    parser.add_argument('--max_retries', help='Maximum retries for ROR affiliation API requests that fail with 429/5xx or connection errors', type=int, default=5)
+    parser.add_argument('--rate_limit', help='Maximum ROR affiliation API requests per second', type=float, default=None)
+    parser.add_argument('--cache_file', help='SQLite file to cache ROR affiliation API responses in across runs', default=None)
+    parser.add_argument('--api_tag', help='Tag cached ROR affiliation API responses are stored under; change it when the API version or matching algorithm changes', default='v1')
+    parser.add_argument('--cache_ttl', help='Hours before cached ROR affiliation API responses are re-queried', type=float, default=None)
+    parser.add_argument('--offline', help='Only use cached ROR affiliation API responses; uncached affiliations fail', action='store_true')
+    return parser
+
+
+def client_from_args(args, pool_size=10, use_async=False):
+    # Builds a client, and its response cache if --cache_file is given, from the options
+    # added by add_client_arguments. The cache is keyed to --base_url and --api_tag. The
+    # async client is used as an async context manager.
+    cache = ResponseCache(args.cache_file, api_tag=args.api_tag, ttl=args.cache_ttl * 3600 if args.cache_ttl else None,
+                          base_url=args.base_url) if args.cache_file else None
+    client_class = AsyncRORAffiliationClient if use_async else RORAffiliationClient
+    return client_class(base_url=args.base_url, timeout=(args.connect_timeout, args.timeout), max_retries=args.max_retries,
+                        rate_limit=args.rate_limit, pool_size=pool_size, cache=cache, offline=args.offline)
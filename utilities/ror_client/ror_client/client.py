@@ -0,0 +1,250 @@
+import csv
+import math
+import time
+import random
+import asyncio
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+__all__ = ['DEFAULT_BASE_URL', 'RORClientError', 'TokenBucket', 'ClientStats',
+           'RORAffiliationClient', 'AsyncRORAffiliationClient', 'get_chosen_result']
+
+DEFAULT_BASE_URL = 'https://api.ror.org'
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+class RORClientError(Exception):
+    pass
+
+
+class TokenBucket:
+    # Allows `rate` requests per second on average, with bursts of up to `capacity`
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or max(1, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _reserve(self):
+        # Takes a token, returning how long the caller must wait before using it
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def acquire(self):
+        wait = self._reserve()
+        if wait:
+            time.sleep(wait)
+
+    async def acquire_async(self):
+        wait = self._reserve()
+        if wait:
+            await asyncio.sleep(wait)
+
+
+class ClientStats:
+    def __init__(self):
+        self.latencies = []
+        self.requests = 0
+        self.retries = 0
+        self.errors = 0
+        self.cache_hits = 0
+        self.lock = threading.Lock()
+
+    def record(self, latency, retries, error=False, cached=False):
+        with self.lock:
+            self.latencies.append(latency)
+            self.requests += 1
+            self.retries += retries
+            if error:
+                self.errors += 1
+            if cached:
+                self.cache_hits += 1
+
+    def get_stats(self):
+        with self.lock:
+            sorted_latencies = sorted(self.latencies)
+            stats = {'requests': self.requests, 'retries': self.retries,
+                     'errors': self.errors, 'cache_hits': self.cache_hits}
+        if sorted_latencies:
+            stats['average'] = sum(sorted_latencies) / len(sorted_latencies)
+            stats['max'] = sorted_latencies[-1]
+            for percentile in (50, 90, 99):
+                rank = max(1, math.ceil(percentile / 100 * len(sorted_latencies)))
+                stats[f'p{percentile}'] = sorted_latencies[rank - 1]
+        return stats
+
+    def write_stats_to_csv(self, filename='ror_api_stats.csv'):
+        with open(filename, 'w', newline='') as f_out:
+            writer = csv.writer(f_out)
+            writer.writerow(['Metric', 'Value'])
+            for metric, value in self.get_stats().items():
+                writer.writerow([metric, f'{value:.6f}' if isinstance(value, float) else value])
+
+
+def get_chosen_result(items):
+    for item in items:
+        if item['chosen']:
+            return item['organization']['id'], item['score']
+    return None
+
+
+def backoff_delay(attempt, backoff_base, backoff_max, retry_after=None):
+    # Honors Retry-After when given, otherwise exponential backoff with full jitter
+    if retry_after:
+        try:
+            return min(backoff_max, float(retry_after))
+        except ValueError:
+            pass
+    return random.uniform(0, min(backoff_max, backoff_base * 2 ** attempt))
+
+
+def check_cache(client, affiliation, require_complete, start):
+    # Returns cached items, or None when the API has to be queried
+    if client.cache:
+        items = client.cache.get(affiliation, require_complete)
+        if items is not None:
+            client.stats.record(time.perf_counter() - start, 0, cached=True)
+            return items
+    if client.offline:
+        client.stats.record(time.perf_counter() - start, 0, error=True)
+        raise RORClientError(f'Not in cache and running offline: {affiliation}')
+    return None
+
+
+def check_cache_base_url(cache, base_url):
+    # A cache keyed to another API would be read and written under the wrong base URL
+    if cache and cache.base_url != base_url.rstrip('/'):
+        raise ValueError(f'Response cache is keyed to {cache.base_url}, but the client queries {base_url}')
+
+
+class RORAffiliationClient:
+    def __init__(self, base_url=DEFAULT_BASE_URL, timeout=(3.05, 30), max_retries=5,
+                 backoff_base=0.5, backoff_max=30, rate_limit=None, pool_size=10, cache=None, offline=False):
+        check_cache_base_url(cache, base_url)
+        self.url = f"{base_url.rstrip('/')}/organizations"
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.rate_limiter = TokenBucket(rate_limit) if rate_limit else None
+        self.cache = cache
+        self.offline = offline
+        self.stats = ClientStats()
+        # One keep-alive session, so connections (and TLS sessions) are reused across queries
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=0)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def query(self, affiliation, require_complete=False):
+        start = time.perf_counter()
+        items = check_cache(self, affiliation, require_complete, start)
+        if items is not None:
+            return items
+        attempt = 0
+        while True:
+            if self.rate_limiter:
+                self.rate_limiter.acquire()
+            retry_after = None
+            try:
+                r = self.session.get(self.url, params={'affiliation': affiliation}, timeout=self.timeout)
+                if r.status_code not in RETRY_STATUSES:
+                    r.raise_for_status()
+                    items = r.json()['items']
+                    if self.cache:
+                        self.cache.put(affiliation, items)
+                    self.stats.record(time.perf_counter() - start, attempt)
+                    return items
+                retry_after = r.headers.get('Retry-After')
+                error = RORClientError(f'HTTP {r.status_code}')
+            except (requests.ConnectionError, requests.Timeout) as e:
+                error = e
+            except Exception:
+                self.stats.record(time.perf_counter() - start, attempt, error=True)
+                raise
+            if attempt >= self.max_retries:
+                self.stats.record(time.perf_counter() - start, attempt, error=True)
+                raise RORClientError(f'Giving up after {attempt + 1} attempts: {error}')
+            time.sleep(backoff_delay(attempt, self.backoff_base, self.backoff_max, retry_after))
+            attempt += 1
+
+    def close(self):
+        self.session.close()
+
+
+class AsyncRORAffiliationClient:
+    def __init__(self, base_url=DEFAULT_BASE_URL, timeout=(3.05, 30), max_retries=5,
+                 backoff_base=0.5, backoff_max=30, rate_limit=None, pool_size=10, cache=None, offline=False):
+        if aiohttp is None:
+            raise ImportError('AsyncRORAffiliationClient requires aiohttp (pip install aiohttp)')
+        check_cache_base_url(cache, base_url)
+        self.url = f"{base_url.rstrip('/')}/organizations"
+        connect_timeout, read_timeout = timeout if isinstance(timeout, tuple) else (timeout, timeout)
+        self.timeout = aiohttp.ClientTimeout(sock_connect=connect_timeout, sock_read=read_timeout)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.rate_limiter = TokenBucket(rate_limit) if rate_limit else None
+        self.cache = cache
+        self.offline = offline
+        self.pool_size = pool_size
+        self.stats = ClientStats()
+        self.session = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        await self.close()
+
+    async def query(self, affiliation, require_complete=False):
+        start = time.perf_counter()
+        items = check_cache(self, affiliation, require_complete, start)
+        if items is not None:
+            return items
+        # The session is created lazily so it belongs to the running event loop
+        if self.session is None:
+            connector = aiohttp.TCPConnector(limit=self.pool_size)
+            self.session = aiohttp.ClientSession(connector=connector, timeout=self.timeout)
+        attempt = 0
+        while True:
+            if self.rate_limiter:
+                await self.rate_limiter.acquire_async()
+            retry_after = None
+            try:
+                async with self.session.get(self.url, params={'affiliation': affiliation}) as r:
+                    if r.status not in RETRY_STATUSES:
+                        r.raise_for_status()
+                        items = (await r.json())['items']
+                        if self.cache:
+                            self.cache.put(affiliation, items)
+                        self.stats.record(time.perf_counter() - start, attempt)
+                        return items
+                    retry_after = r.headers.get('Retry-After')
+                    error = RORClientError(f'HTTP {r.status}')
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+                error = e
+            except Exception:
+                self.stats.record(time.perf_counter() - start, attempt, error=True)
+                raise
+            if attempt >= self.max_retries:
+                self.stats.record(time.perf_counter() - start, attempt, error=True)
+                raise RORClientError(f'Giving up after {attempt + 1} attempts: {error}')
+            await asyncio.sleep(backoff_delay(attempt, self.backoff_base, self.backoff_max, retry_after))
+            attempt += 1
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
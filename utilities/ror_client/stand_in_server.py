@@ -0,0 +1,248 @@
+import os
+import json
+import gzip
+import math
+import zlib
+import time
+import random
+import argparse
+import logging
+import threading
+import requests
+from datetime import datetime
+from urllib.parse import urlparse, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from ror_client import DEFAULT_BASE_URL, compact_items, expand_items, normalize_cache_key
+
+now = datetime.now()
+script_start = now.strftime('%Y%m%d_%H%M%S')
+logging.basicConfig(filename=f'{script_start}_stand_in_server.log', level=logging.INFO,
+                    format='%(asctime)s %(levelname)s %(message)s')
+
+
+class Recordings:
+    # Recorded responses, stored as one JSON line per affiliation:
+    # {"affiliation": ..., "items": [[id, name, score, chosen, matching_type], ...], "latency": seconds}
+    # Files ending in .gz hold one complete gzip member per line, so every record written
+    # is readable even if the server is killed while recording.
+    def __init__(self, path):
+        self.path = path
+        self.compressed = path.endswith('.gz')
+        self.responses = {}
+        self.lock = threading.Lock()
+        self.f_out = None
+        self.damaged = False
+        if os.path.exists(path):
+            self.load()
+
+    def load(self):
+        # A server killed mid-write can leave a truncated last line or gzip member. The
+        # records before it are kept, and the rest of the file is skipped.
+        try:
+            with (gzip.open(self.path, 'rt', encoding='utf-8') if self.compressed
+                  else open(self.path, encoding='utf-8')) as f_in:
+                for line in f_in:
+                    try:
+                        record = json.loads(line)
+                        self.responses[record['affiliation']] = (record['items'], record['latency'])
+                    except (ValueError, KeyError, TypeError):
+                        self.damaged = True
+        except (EOFError, OSError, ValueError, zlib.error) as e:
+            self.damaged = True
+            logging.warning(f'Error reading recordings {self.path}: {e}')
+        if self.damaged:
+            message = f'{self.path} has a truncated or corrupt record, kept {len(self.responses)} responses'
+            logging.warning(message)
+            print(f'Warning: {message}')
+
+    def get(self, affiliation):
+        return self.responses.get(normalize_cache_key(affiliation))
+
+    def encode(self, affiliation, items, latency):
+        line = json.dumps({'affiliation': affiliation, 'items': items, 'latency': latency}) + '\n'
+        return gzip.compress(line.encode('utf-8')) if self.compressed else line.encode('utf-8')
+
+    def rewrite(self):
+        # Replaces a damaged file with the records that were read from it, so new records
+        # are not appended after the damaged tail
+        temp_path = f'{self.path}.tmp'
+        with open(temp_path, 'wb') as f_temp:
+            for affiliation, (items, latency) in self.responses.items():
+                f_temp.write(self.encode(affiliation, items, latency))
+        os.replace(temp_path, self.path)
+        self.damaged = False
+
+    def add(self, affiliation, items, latency):
+        affiliation, items, latency = normalize_cache_key(affiliation), compact_items(items), round(latency, 4)
+        with self.lock:
+            self.responses[affiliation] = (items, latency)
+            if self.f_out is None:
+                if self.damaged:
+                    self.rewrite()
+                self.f_out = open(self.path, 'ab')
+            self.f_out.write(self.encode(affiliation, items, latency))
+            self.f_out.flush()
+
+    def close(self):
+        if self.f_out is not None:
+            self.f_out.close()
+
+
+class FaultModel:
+    # Draws latencies and injected errors. Each draw is seeded from the affiliation and
+    # how often it has been requested, so a run is reproducible regardless of the
+    # order in which concurrent requests arrive, and retries see fresh draws.
+    def __init__(self, latency, latency_ms, latency_sigma, error_rate, error_statuses, seed):
+        self.latency = latency
+        self.latency_ms = latency_ms
+        self.latency_sigma = latency_sigma
+        self.error_rate = error_rate
+        self.error_statuses = error_statuses
+        self.seed = seed
+        self.attempts = {}
+        self.lock = threading.Lock()
+
+    def draw(self, affiliation, recorded_latency):
+        with self.lock:
+            attempt = self.attempts.get(affiliation, 0)
+            self.attempts[affiliation] = attempt + 1
+        rng = random.Random(f'{self.seed}\0{affiliation}\0{attempt}')
+        if self.latency == 'fixed':
+            delay = self.latency_ms / 1000
+        elif self.latency == 'uniform':
+            delay = rng.uniform(0, 2 * self.latency_ms) / 1000
+        elif self.latency == 'lognormal':
+            delay = rng.lognormvariate(math.log(self.latency_ms), self.latency_sigma) / 1000
+        elif self.latency == 'recorded':
+            delay = recorded_latency or 0.0
+        else:
+            delay = 0.0
+        status = rng.choice(self.error_statuses) if rng.random() < self.error_rate else None
+        return delay, status
+
+
+class StandInStats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counts = {'requests': 0, 'replayed': 0, 'recorded': 0, 'missing': 0,
+                       'injected_errors': 0, 'upstream_errors': 0}
+
+    def record(self, outcome):
+        with self.lock:
+            self.counts['requests'] += 1
+            self.counts[outcome] += 1
+
+    def get_stats(self):
+        with self.lock:
+            return dict(self.counts)
+
+
+class StandInRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        if url.path == '/stats':
+            self.send_json(200, self.server.stats.get_stats())
+            return
+        if url.path.rstrip('/') != '/organizations':
+            self.send_json(404, {'errors': [f'Unknown path: {url.path}']})
+            return
+        affiliation = parse_qs(url.query).get('affiliation', [''])[0]
+        if not affiliation:
+            self.send_json(400, {'errors': ['Missing affiliation parameter']})
+            return
+        recorded = self.server.recordings.get(affiliation)
+        delay, status = self.server.faults.draw(affiliation, recorded[1] if recorded else None)
+        if status:
+            time.sleep(delay)
+            self.server.stats.record('injected_errors')
+            self.send_json(status, {'errors': [f'Injected {status}']}, {'Retry-After': '1'} if status == 429 else None)
+            return
+        if recorded:
+            time.sleep(delay)
+            self.server.stats.record('replayed')
+            items = expand_items(recorded[0])
+        elif self.server.upstream:
+            try:
+                start = time.perf_counter()
+                r = self.server.upstream.get(self.server.upstream_url, params={'affiliation': affiliation}, timeout=(3.05, 30))
+                latency = time.perf_counter() - start
+                r.raise_for_status()
+                items = r.json()['items']
+            except Exception as e:
+                # Upstream error statuses are passed through so the client retries as it would against the API
+                logging.error(f'Upstream error for {affiliation}: {e}')
+                self.server.stats.record('upstream_errors')
+                status = e.response.status_code if isinstance(e, requests.HTTPError) else 502
+                self.send_json(status, {'errors': [f'Upstream error: {e}']})
+                return
+            self.server.recordings.add(affiliation, items, latency)
+            self.server.stats.record('recorded')
+        else:
+            self.server.stats.record('missing')
+            self.send_json(404, {'errors': [f'No recorded response for: {affiliation}']})
+            return
+        self.send_json(200, {'number_of_results': len(items), 'items': items})
+
+    def send_json(self, status, payload, headers=None):
+        response = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(response)))
+        for header, value in (headers or {}).items():
+            self.send_header(header, value)
+        self.end_headers()
+        self.wfile.write(response)
+
+    def log_message(self, format, *args):
+        logging.debug(format % args)
+
+
+def create_server(args):
+    server = ThreadingHTTPServer((args.host, args.port), StandInRequestHandler)
+    server.recordings = Recordings(args.recordings)
+    server.faults = FaultModel(args.latency, args.latency_ms, args.latency_sigma, args.error_rate,
+                               [int(status) for status in args.error_statuses.split(',')], args.seed)
+    server.stats = StandInStats()
+    server.upstream = requests.Session() if args.record else None
+    server.upstream_url = f"{args.upstream.rstrip('/')}/organizations"
+    return server
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(
+        description='Serve ROR affiliation API responses (/organizations?affiliation=) from recordings, with injected latency and errors.')
+    parser.add_argument('-r', '--recordings', help='JSON lines file of recorded responses, gzipped if it ends in .gz', default='ror_api_recordings.jsonl')
+    parser.add_argument('--record', help='Query the upstream API for affiliations that are not recorded yet and append their responses to the recordings', action='store_true')
+    parser.add_argument('--upstream', help='Base URL of the API to record from', default=DEFAULT_BASE_URL)
+    parser.add_argument('--host', help='Host to listen on', default='127.0.0.1')
+    parser.add_argument('--port', help='Port to listen on', type=int, default=8790)
+    parser.add_argument('--latency', help='Latency added to replayed responses', choices=['none', 'fixed', 'uniform', 'lognormal', 'recorded'], default='none')
+    parser.add_argument('--latency_ms', help='Latency in milliseconds: the value for fixed, the mean for uniform (drawn from [0, 2 * latency_ms]) and the median for lognormal', type=float, default=100)
+    parser.add_argument('--latency_sigma', help='Shape of the lognormal latency distribution', type=float, default=0.5)
+    parser.add_argument('--error_rate', help='Fraction of requests answered with an injected error', type=float, default=0.0)
+    parser.add_argument('--error_statuses', help='Comma separated HTTP statuses to choose injected errors from', default='503')
+    parser.add_argument('--seed', help='Seed for latency and error draws', type=int, default=0)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_arguments()
+    server = create_server(args)
+    message = f'Listening on http://{args.host}:{args.port} with {len(server.recordings.responses)} recorded responses'
+    logging.info(message)
+    print(message)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        logging.info(f'Shutting down: {json.dumps(server.stats.get_stats())}')
+        server.server_close()
+        server.recordings.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,30 @@
+import argparse
+from ror_client import DEFAULT_BASE_URL, ResponseCache
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(
+        description='Warm a ROR affiliation API response cache from the results CSV of a previous run.')
+    parser.add_argument('-i', '--input', help='Results CSV file (e.g. ror-affiliation_results.csv)', required=True)
+    parser.add_argument('-c', '--cache_file', help='SQLite cache file', default='ror_api_cache.sqlite')
+    parser.add_argument('--base_url', help='Base URL of the ROR API the results were produced with; entries are only served to clients querying it', default=DEFAULT_BASE_URL)
+    parser.add_argument('--api_tag', help='Tag to store the entries under', default='v1')
+    parser.add_argument('--id_column', help='Column holding the chosen ROR ID', default='predicted_ror_id')
+    parser.add_argument('--score_column', help='Column holding the chosen score', default='prediction_score')
+    parser.add_argument('--include_negatives', help='Also cache rows without a predicted ID as "no match". Only use this if the run had no failed requests, which also leave the ID empty', action='store_true')
+    parser.add_argument('--cache_ttl', help='Hours before cached responses expire; expired entries are purged first', type=float, default=None)
+    return parser.parse_args()
+
+
+def main():
+    args = parse_arguments()
+    cache = ResponseCache(args.cache_file, api_tag=args.api_tag, ttl=args.cache_ttl * 3600 if args.cache_ttl else None,
+                          base_url=args.base_url)
+    purged = cache.purge_expired()
+    added = cache.warm_from_csv(args.input, args.id_column, args.score_column, args.include_negatives)
+    cache.close()
+    print(f'Purged {purged} expired entries, added {added} entries to {args.cache_file}')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,7 @@
 import csv
+import math
 import time
+import itertools
 
 
 class LoopTimerContext:
@@ -13,6 +15,9 @@ class LoopTimerContext:
         end = time.perf_counter()
         self.execution_times.append(end - self.start)
 
+    def record(self, execution_time):
+        self.execution_times.append(execution_time)
+
     def get_stats(self):
         sorted_times = sorted(self.execution_times)
         middle_index = len(self.execution_times) // 2
@@ -29,6 +34,15 @@ class LoopTimerContext:
             'median': median,
         }
 
+    def get_percentiles(self, percentiles=(50, 90, 95, 99)):
+        # Nearest-rank percentiles
+        sorted_times = sorted(self.execution_times)
+        results = {}
+        for percentile in percentiles:
+            rank = max(1, math.ceil(percentile / 100 * len(sorted_times)))
+            results[percentile] = sorted_times[rank - 1]
+        return results
+
     def write_stats_to_csv(self, filename="timing_stats.csv"):
         stats = self.get_stats()
         with open(filename, 'w', newline='') as csvfile:
@@ -43,3 +57,12 @@ class LoopTimerContext:
                 'Max Execution Time': f"{stats['max']:.6f}",
                 'Median Execution Time': f"{stats['median']:.6f}"
             })
+
+
+def read_chunks(reader, chunk_size):
+    # Yields lists of up to chunk_size rows, for scripts that process and time rows in batches
+    while True:
+        chunk = list(itertools.islice(reader, chunk_size))
+        if not chunk:
+            break
+        yield chunk
@@ -1,12 +1,16 @@
+import os
+import json
+import shutil
 import argparse
-import pickle
+import tempfile
 import tqdm
 import faiss
 import torch
 import numpy as np
 import pandas as pd
 from tqdm import tqdm
-from transformers import AutoTokenizer, AutoModel
+from mapping_store import MappingStore, MappingStoreWriter
+from onnx_backend import load_model_and_tokenizer, get_model_id
 
 
 def parse_args():
@@ -18,20 +22,50 @@ def parse_args():
                         help="Model checkpoint for transformers.")
     parser.add_argument("-d", "--device", default="cpu",
                         choices=["cpu", "cuda"], help="Device to use for index computations.")
+    parser.add_argument("--backend", default="torch", choices=["torch", "onnx"],
+                        help="Run the embeddings model with PyTorch, or with ONNX Runtime on CPU from an export_onnx.py export.")
+    parser.add_argument("--onnx_model", default="onnx_model/model.onnx",
+                        help="ONNX model file written by export_onnx.py, used with --backend onnx.")
     parser.add_argument("-i", "--index_file", default="affiliations.index",
                         help="Path to save the index.")
-    parser.add_argument("-m", "--mapping_file", default="mapping.pkl",
-                        help="Path to save the index to affiliation and label mapping.")
+    parser.add_argument("-m", "--mapping_file", default="mapping",
+                        help="Directory to save the index to affiliation and label mapping store.")
+    parser.add_argument("-b", "--batch_size", type=int, default=64,
+                        help="Number of affiliations to embed per forward pass.")
+    parser.add_argument("-s", "--streaming", action="store_true",
+                        help="Read the CSV in chunks and write embeddings to a memory-mapped file, resuming an interrupted build.")
+    parser.add_argument("--chunk_size", type=int, default=100000,
+                        help="Number of CSV rows per chunk in streaming mode.")
+    parser.add_argument("-e", "--embeddings_file", default=None,
+                        help="Path of the memory-mapped embeddings file in streaming mode. (Default: index file + .embeddings.npy)")
+    parser.add_argument("-t", "--index_type", default="flat", choices=["flat", "hnsw", "ivf_flat"],
+                        help="FAISS index type: exact search, or approximate search with HNSW or IVF-Flat.")
+    parser.add_argument("--hnsw_m", type=int, default=32,
+                        help="Number of neighbors per node in the HNSW graph.")
+    parser.add_argument("--ef_construction", type=int, default=200,
+                        help="HNSW candidate list size while building.")
+    parser.add_argument("--ef_search", type=int, default=64,
+                        help="HNSW candidate list size while searching, stored with the index.")
+    parser.add_argument("--nlist", type=int, default=None,
+                        help="Number of IVF clusters. (Default: 4 * sqrt(rows))")
+    parser.add_argument("--nprobe", type=int, default=16,
+                        help="Number of IVF clusters visited while searching, stored with the index.")
+    parser.add_argument("--train_size", type=int, default=None,
+                        help="Number of embeddings sampled to train IVF clusters. (Default: 50 * nlist, at most all rows)")
+    parser.add_argument("-a", "--aggregate", default="none", choices=["none", "mean", "medoids"],
+                        help="Index one vector per affiliation, or aggregate each label's embeddings into their mean or k-means medoids.")
+    parser.add_argument("--centroids_per_label", type=int, default=3,
+                        help="Maximum number of medoids indexed per label when aggregating with medoids.")
     return parser.parse_args()
 
 
-def read_csv_file(input_file, csv_delimiter=','):
-    return pd.read_csv(input_file, delimiter=csv_delimiter, encoding='unicode_escape', names=['label', 'affiliation'])
+def read_csv_file(input_file, csv_delimiter=',', chunk_size=None):
+    return pd.read_csv(input_file, delimiter=csv_delimiter, encoding='unicode_escape', names=['label', 'affiliation'],
+                       chunksize=chunk_size)
 
 
-def get_model_and_tokenizer(model_ckpt, device):
-    tokenizer = AutoTokenizer.from_pretrained(model_ckpt)
-    model = AutoModel.from_pretrained(model_ckpt)
+def get_model_and_tokenizer(model_ckpt, device, backend="torch", onnx_model=None):
+    tokenizer, model = load_model_and_tokenizer(backend, model_ckpt, onnx_model)
     model.to(device)
     return tokenizer, model
 
@@ -46,29 +80,229 @@ def get_embeddings(tokenizer, model, text_list, device):
     return cls_pooling(model_output).detach().cpu().numpy()
 
 
-def build_faiss_index(all_embeddings):
-    d = all_embeddings.shape[1]
-    index = faiss.IndexFlatL2(d)
-    index.add(all_embeddings)
-    return index
+def create_embeddings(tokenizer, model, texts, device, batch_size, desc="Creating embeddings"):
+    # Texts are embedded in order of token length, so each batch pads to about the
+    # same length, and each batch is written to its original rows of the matrix
+    lengths = [len(input_ids) for input_ids in tokenizer(texts, truncation=True)['input_ids']]
+    order = np.argsort(lengths, kind='stable')
+    embeddings = np.empty((len(texts), model.config.hidden_size), dtype=np.float32)
+    with torch.inference_mode():
+        for start in tqdm(range(0, len(texts), batch_size), desc=desc):
+            batch_indices = order[start:start + batch_size]
+            embeddings[batch_indices] = get_embeddings(
+                tokenizer, model, [texts[i] for i in batch_indices], device)
+    return embeddings
 
 
-def save_data(index, mapping, index_file, mapping_file):
+def group_by_label(label_codes):
+    # Returns row indices ordered by label code and the start of each label's run in them
+    order = np.argsort(label_codes, kind='stable')
+    sorted_codes = label_codes[order]
+    starts = np.flatnonzero(np.r_[True, sorted_codes[1:] != sorted_codes[:-1]])
+    return order, starts
+
+
+def aggregate_mean(all_embeddings, label_codes, chunk_size=100000):
+    # Returns the mean embedding of each label, and for each label the row nearest its
+    # mean, whose affiliation represents the label in the mapping. Rows are read a chunk
+    # at a time, so a memory-mapped matrix is not loaded whole.
+    n_labels = int(label_codes.max()) + 1
+    sums = np.zeros((n_labels, all_embeddings.shape[1]), dtype=np.float64)
+    for start in tqdm(range(0, len(label_codes), chunk_size), desc="Summing embeddings"):
+        codes = np.asarray(label_codes[start:start + chunk_size])
+        order, starts = group_by_label(codes)
+        chunk = np.asarray(all_embeddings[start:start + chunk_size])[order]
+        sums[codes[order[starts]]] += np.add.reduceat(chunk, starts, axis=0)
+    means = (sums / np.bincount(label_codes, minlength=n_labels)[:, None]).astype(np.float32)
+    best_distances = np.full(n_labels, np.inf, dtype=np.float32)
+    best_rows = np.zeros(n_labels, dtype=np.int64)
+    for start in tqdm(range(0, len(label_codes), chunk_size), desc="Finding representatives"):
+        codes = np.asarray(label_codes[start:start + chunk_size])
+        distances = ((np.asarray(all_embeddings[start:start + chunk_size]) - means[codes]) ** 2).sum(axis=1)
+        order = np.lexsort((distances, codes))
+        nearest = order[np.flatnonzero(np.r_[True, codes[order][1:] != codes[order][:-1]])]
+        better = distances[nearest] < best_distances[codes[nearest]]
+        best_distances[codes[nearest[better]]] = distances[nearest[better]]
+        best_rows[codes[nearest[better]]] = start + nearest[better]
+    return means, np.arange(n_labels), best_rows
+
+
+def kmeans_medoids(vectors, k, iterations=20, seed=0):
+    # Clusters the vectors with k-means and returns the row nearest each centroid, so the
+    # indexed vectors are real affiliations rather than averages of them
+    def squared_distances(centroids):
+        return (vectors ** 2).sum(axis=1)[:, None] - 2 * vectors @ centroids.T + (centroids ** 2).sum(axis=1)
+    centroids = vectors[np.random.default_rng(seed).choice(len(vectors), k, replace=False)]
+    for _ in range(iterations):
+        assignment = squared_distances(centroids).argmin(axis=1)
+        updated = np.array([vectors[assignment == j].mean(axis=0) if np.any(assignment == j) else centroids[j]
+                            for j in range(k)])
+        if np.allclose(updated, centroids):
+            break
+        centroids = updated
+    return np.unique(squared_distances(centroids).argmin(axis=0))
+
+
+def aggregate_medoids(all_embeddings, label_codes, centroids_per_label):
+    # Returns up to `centroids_per_label` medoid embeddings per label, with their label
+    # codes and rows. Labels with no more rows than that keep every row.
+    order, starts = group_by_label(np.asarray(label_codes))
+    ends = np.r_[starts[1:], len(order)]
+    codes, rows = [], []
+    for start, end in tqdm(zip(starts, ends), total=len(starts), desc="Finding medoids"):
+        label_rows = order[start:end]
+        if len(label_rows) > centroids_per_label:
+            label_rows = label_rows[kmeans_medoids(np.asarray(all_embeddings[label_rows]), centroids_per_label)]
+        codes.append(np.full(len(label_rows), label_codes[order[start]]))
+        rows.append(label_rows)
+    codes, rows = np.concatenate(codes), np.concatenate(rows)
+    # Rows are read in file order, so a memory-mapped matrix is read sequentially
+    read_order = np.argsort(rows)
+    embeddings = np.empty((len(rows), all_embeddings.shape[1]), dtype=np.float32)
+    embeddings[read_order] = all_embeddings[rows[read_order]]
+    return embeddings, codes, rows
+
+
+def aggregate_by_label(all_embeddings, examples, aggregate, centroids_per_label, mapping_file, chunk_size=100000):
+    # Replaces the per-affiliation embeddings with per-label ones and writes the mapping
+    # store for them. Each indexed vector maps to its label and to the affiliation it
+    # came from (medoids) or nearest to it (mean).
+    label_codes = np.asarray(examples.label_codes)
+    if aggregate == "mean":
+        embeddings, codes, rows = aggregate_mean(all_embeddings, label_codes, chunk_size)
+    else:
+        embeddings, codes, rows = aggregate_medoids(all_embeddings, label_codes, centroids_per_label)
+    mapping_writer = MappingStoreWriter(mapping_file)
+    mapping_writer.add(examples.vocabulary[codes].tolist(), [examples.get_affiliation(row) for row in rows])
+    mapping_writer.close()
+    print(f"Aggregated {len(label_codes)} affiliations into {len(embeddings)} vectors for {len(examples.vocabulary) - 1} labels")
+    return embeddings
+
+
+def build_faiss_index(all_embeddings, index_type="flat", hnsw_m=32, ef_construction=200, ef_search=64,
+                      nlist=None, nprobe=16, train_size=None, add_chunk_size=100000):
+    # Returns the index and the parameters it was built with, which are saved alongside
+    # it so search.py can apply the search-time ones (efSearch, nprobe)
+    n, d = all_embeddings.shape
+    params = {'index_type': index_type, 'dim': d, 'rows': n}
+    if index_type == "hnsw":
+        index = faiss.IndexHNSWFlat(d, hnsw_m)
+        index.hnsw.efConstruction = ef_construction
+        index.hnsw.efSearch = ef_search
+        params.update({'hnsw_m': hnsw_m, 'ef_construction': ef_construction, 'ef_search': ef_search})
+    elif index_type == "ivf_flat":
+        nlist = nlist or max(1, int(4 * np.sqrt(n)))
+        train_size = min(n, train_size or 50 * nlist)
+        quantizer = faiss.IndexFlatL2(d)
+        index = faiss.IndexIVFFlat(quantizer, d, nlist)
+        # Sorted sample indices keep reads from a memory-mapped matrix sequential
+        sample = np.sort(np.random.default_rng(0).choice(n, train_size, replace=False))
+        index.train(np.ascontiguousarray(all_embeddings[sample]))
+        index.nprobe = nprobe
+        params.update({'nlist': nlist, 'nprobe': nprobe, 'train_size': train_size})
+    else:
+        index = faiss.IndexFlatL2(d)
+    # Added in chunks, so a memory-mapped matrix is paged in a chunk at a time
+    for start in tqdm(range(0, n, add_chunk_size), desc="Adding to index"):
+        index.add(np.ascontiguousarray(all_embeddings[start:start + add_chunk_size]))
+    return index, params
+
+
+def load_checkpoint(checkpoint_file, build_info):
+    # Returns the number of rows already embedded, or 0 if there is no checkpoint or it
+    # belongs to a different input, model or chunk size
+    if not os.path.exists(checkpoint_file):
+        return 0
+    with open(checkpoint_file) as f:
+        checkpoint = json.load(f)
+    if checkpoint['build'] != build_info:
+        print(f"Checkpoint {checkpoint_file} is for a different build, starting over")
+        return 0
+    return checkpoint['completed_rows']
+
+
+def save_checkpoint(checkpoint_file, build_info, completed_rows):
+    temp_file = f"{checkpoint_file}.tmp"
+    with open(temp_file, "w") as f:
+        json.dump({'build': build_info, 'completed_rows': completed_rows}, f)
+    os.replace(temp_file, checkpoint_file)
+
+
+def create_embeddings_streaming(input_file, tokenizer, model, device, batch_size, chunk_size, embeddings_file, model_ckpt,
+                                mapping_writer):
+    # Embeds the CSV a chunk at a time into a memory-mapped .npy file, checkpointing after
+    # each chunk. Chunks embedded by an interrupted run with the same input, model and
+    # chunk size are skipped. Labels and affiliations from every chunk are added to the
+    # mapping store. Returns the memory-mapped embeddings.
+    total_rows = sum(len(chunk) for chunk in read_csv_file(input_file, chunk_size=chunk_size))
+    build_info = {'input_file': os.path.abspath(input_file), 'input_size': os.path.getsize(input_file),
+                  'rows': total_rows, 'dim': model.config.hidden_size, 'model_ckpt': model_ckpt,
+                  'chunk_size': chunk_size}
+    checkpoint_file = f"{embeddings_file}.checkpoint.json"
+    completed_rows = load_checkpoint(checkpoint_file, build_info) if os.path.exists(embeddings_file) else 0
+    if completed_rows:
+        print(f"Resuming from row {completed_rows} of {total_rows}")
+        embeddings = np.lib.format.open_memmap(embeddings_file, mode='r+')
+    else:
+        embeddings = np.lib.format.open_memmap(embeddings_file, mode='w+', dtype=np.float32,
+                                               shape=(total_rows, model.config.hidden_size))
+        save_checkpoint(checkpoint_file, build_info, 0)
+    start = 0
+    for chunk in read_csv_file(input_file, chunk_size=chunk_size):
+        end = start + len(chunk)
+        mapping_writer.add(chunk['label'].tolist(), chunk['affiliation'].tolist())
+        if end > completed_rows:
+            embeddings[start:end] = create_embeddings(
+                tokenizer, model, chunk['affiliation'].tolist(), device, batch_size,
+                desc=f"Creating embeddings (rows {start}-{end} of {total_rows})")
+            embeddings.flush()
+            save_checkpoint(checkpoint_file, build_info, end)
+        start = end
+    return embeddings
+
+
+def save_data(index, params, index_file):
     faiss.write_index(index, index_file)
-    with open(mapping_file, "wb") as f:
-        pickle.dump(mapping, f)
+    with open(f"{index_file}.params.json", "w") as f:
+        json.dump(params, f, indent=2)
 
 
 def main():
     args = parse_args()
-    df = read_csv_file(args.input_file)
-    tokenizer, model = get_model_and_tokenizer(args.model_ckpt, args.device)
-    all_embeddings = np.vstack([get_embeddings(tokenizer, model, [affil], args.device)
-                                for affil in tqdm(df['affiliation'], desc="Creating embeddings")])
-    index = build_faiss_index(all_embeddings)
-    mapping = {i: {'label': label, 'affiliation': affiliation}
-                     for i, (label, affiliation) in enumerate(zip(df['label'], df['affiliation']))}
-    save_data(index, mapping, args.index_file, args.mapping_file)
+    tokenizer, model = get_model_and_tokenizer(args.model_ckpt, args.device, args.backend, args.onnx_model)
+    # When aggregating, the per-affiliation mapping is only needed until the per-label one is written
+    examples_mapping_file = tempfile.mkdtemp() if args.aggregate != "none" else args.mapping_file
+    mapping_writer = MappingStoreWriter(examples_mapping_file)
+    if args.streaming:
+        embeddings_file = args.embeddings_file or f"{args.index_file}.embeddings.npy"
+        all_embeddings = create_embeddings_streaming(
+            args.input_file, tokenizer, model, args.device, args.batch_size, args.chunk_size,
+            embeddings_file, get_model_id(args.backend, args.model_ckpt, args.onnx_model), mapping_writer)
+    else:
+        df = read_csv_file(args.input_file)
+        affiliations = df['affiliation'].tolist()
+        mapping_writer.add(df['label'].tolist(), affiliations)
+        all_embeddings = create_embeddings(tokenizer, model, affiliations,
+                                           args.device, args.batch_size)
+    mapping_writer.close()
+    aggregate_params = {}
+    if args.aggregate != "none":
+        examples = MappingStore.load(examples_mapping_file)
+        aggregate_params = {'aggregate': args.aggregate, 'examples': len(examples),
+                            'centroids_per_label': args.centroids_per_label if args.aggregate == "medoids" else 1}
+        # Each label takes up to centroids_per_label neighbors, so search.py reads enough
+        # neighbors to see at least 10 labels
+        aggregate_params['search_k'] = 10 * aggregate_params['centroids_per_label']
+        all_embeddings = aggregate_by_label(all_embeddings, examples, args.aggregate, args.centroids_per_label,
+                                            args.mapping_file, args.chunk_size)
+        del examples
+        shutil.rmtree(examples_mapping_file)
+    index, params = build_faiss_index(all_embeddings, args.index_type, args.hnsw_m, args.ef_construction,
+                                      args.ef_search, args.nlist, args.nprobe, args.train_size)
+    params['model_ckpt'] = args.model_ckpt
+    params['backend'] = args.backend
+    params.update(aggregate_params)
+    save_data(index, params, args.index_file)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,95 @@
+import os
+import csv
+import time
+import argparse
+import faiss
+import numpy as np
+from build import read_csv_file, create_embeddings
+from onnx_backend import export_onnx, load_model_and_tokenizer
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Export the embeddings model to ONNX and check its parity with the PyTorch model.")
+    parser.add_argument("-c", "--model_ckpt", default="sentence-transformers/multi-qa-mpnet-base-dot-v1",
+                        help="Model checkpoint for transformers.")
+    parser.add_argument("-o", "--output_dir", default="onnx_model",
+                        help="Directory to save the ONNX model, tokenizer and config.")
+    parser.add_argument("-q", "--quantize", action="store_true",
+                        help="Also save a copy with weights dynamically quantized to int8.")
+    parser.add_argument("-p", "--parity_file", default=None,
+                        help="CSV file in the build.py input format whose affiliations are used for the parity check.")
+    parser.add_argument("--parity_rows", type=int, default=5000,
+                        help="Number of rows of the parity file to embed.")
+    parser.add_argument("--num_queries", type=int, default=500,
+                        help="Number of those rows searched against the rest for recall@k.")
+    parser.add_argument("-k", "--k", type=int, default=10,
+                        help="Number of neighbors compared for recall@k.")
+    parser.add_argument("-b", "--batch_size", type=int, default=64,
+                        help="Number of affiliations to embed per forward pass.")
+    parser.add_argument("--parity_output", default="onnx_parity_stats.csv",
+                        help="Output CSV file for the parity check.")
+    return parser.parse_args()
+
+
+def embed_timed(backend, model_ckpt, onnx_model, affiliations, batch_size):
+    tokenizer, model = load_model_and_tokenizer(backend, model_ckpt, onnx_model)
+    start = time.perf_counter()
+    embeddings = create_embeddings(tokenizer, model, affiliations, "cpu", batch_size,
+                                   desc=f"Creating embeddings ({onnx_model or backend})")
+    return embeddings, time.perf_counter() - start
+
+
+def search_neighbors(embeddings, num_queries, k):
+    # The first num_queries rows are searched against an exact index of the rest
+    index = faiss.IndexFlatL2(embeddings.shape[1])
+    index.add(embeddings[num_queries:])
+    _, I = index.search(embeddings[:num_queries], k)
+    return I
+
+
+def check_parity(model_ckpt, onnx_models, parity_file, parity_rows, num_queries, k, batch_size):
+    # Compares each ONNX model with the PyTorch model on the same affiliations: cosine
+    # similarity of the embeddings, recall@1 and recall@k of the PyTorch neighbors when
+    # searching with ONNX embeddings on both sides, and embedding time
+    affiliations = [a if isinstance(a, str) else '' for a in read_csv_file(parity_file)['affiliation'][:parity_rows]]
+    num_queries = min(num_queries, len(affiliations) // 2)
+    torch_embeddings, torch_time = embed_timed('torch', model_ckpt, None, affiliations, batch_size)
+    true_neighbors = search_neighbors(torch_embeddings, num_queries, k)
+    results = [{'model': model_ckpt, 'backend': 'torch', 'rows': len(affiliations), 'mean_cosine': 1.0,
+                'min_cosine': 1.0, 'recall@1': 1.0, f'recall@{k}': 1.0, 'seconds': torch_time, 'speedup': 1.0}]
+    for onnx_model in onnx_models:
+        embeddings, onnx_time = embed_timed('onnx', model_ckpt, onnx_model, affiliations, batch_size)
+        cosine = np.sum(embeddings * torch_embeddings, axis=1) / (
+            np.linalg.norm(embeddings, axis=1) * np.linalg.norm(torch_embeddings, axis=1))
+        neighbors = search_neighbors(embeddings, num_queries, k)
+        recall_at_k = np.mean([len(set(found) & set(true)) / k for found, true in zip(neighbors, true_neighbors)])
+        results.append({'model': onnx_model, 'backend': 'onnx', 'rows': len(affiliations),
+                        'mean_cosine': float(cosine.mean()), 'min_cosine': float(cosine.min()),
+                        'recall@1': float(np.mean(neighbors[:, 0] == true_neighbors[:, 0])),
+                        f'recall@{k}': float(recall_at_k), 'seconds': onnx_time, 'speedup': torch_time / onnx_time})
+    return results
+
+
+def write_parity_results(results, output_file):
+    with open(output_file, 'w', newline='') as f_out:
+        writer = csv.DictWriter(f_out, fieldnames=list(results[0].keys()))
+        writer.writeheader()
+        for result in results:
+            writer.writerow({key: f'{value:.4f}' if isinstance(value, float) else value
+                             for key, value in result.items()})
+
+
+def main():
+    args = parse_args()
+    exported_file = export_onnx(args.model_ckpt, args.output_dir, args.quantize)
+    onnx_models = sorted({os.path.join(args.output_dir, "model.onnx"), exported_file})
+    print(f"Exported {', '.join(onnx_models)}")
+    if args.parity_file:
+        results = check_parity(args.model_ckpt, onnx_models, args.parity_file, args.parity_rows,
+                               args.num_queries, args.k, args.batch_size)
+        write_parity_results(results, args.parity_output)
+
+
+if __name__ == "__main__":
+    main()
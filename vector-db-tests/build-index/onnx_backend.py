@@ -0,0 +1,93 @@
+import os
+import types
+import inspect
+import torch
+from transformers import AutoConfig, AutoTokenizer, AutoModel
+
+# ONNX Runtime backend for the embeddings model. export_onnx writes an ONNX export of a
+# checkpoint, optionally with dynamically int8-quantized weights, next to its tokenizer and
+# config. OnnxEmbedder runs it with the same call and output as the transformers model, so
+# the embedding code does not depend on the backend.
+
+
+class LastHiddenState(torch.nn.Module):
+    # Takes the model inputs by position and returns only last_hidden_state, so the export
+    # has fixed input names and a single output
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, input_ids, attention_mask, token_type_ids=None):
+        inputs = {'input_ids': input_ids, 'attention_mask': attention_mask}
+        if token_type_ids is not None:
+            inputs['token_type_ids'] = token_type_ids
+        return self.model(**inputs).last_hidden_state
+
+
+def export_onnx(model_ckpt, output_dir, quantize=False, opset_version=14):
+    # Returns the path of the exported model, the quantized one if `quantize`
+    import onnx
+    os.makedirs(output_dir, exist_ok=True)
+    tokenizer = AutoTokenizer.from_pretrained(model_ckpt)
+    model = AutoModel.from_pretrained(model_ckpt)
+    model.eval()
+    tokenizer.save_pretrained(output_dir)
+    model.config.save_pretrained(output_dir)
+    encoded_input = tokenizer(['Example affiliation', 'Department of Physics, Example University'],
+                              padding=True, return_tensors="pt")
+    input_names = [name for name in ('input_ids', 'attention_mask', 'token_type_ids') if name in encoded_input]
+    model_file = os.path.join(output_dir, 'model.onnx')
+    # Batch size and sequence length are dynamic, so any batch the scripts build can be run.
+    # Newer torch versions default to the dynamo exporter, which ignores dynamic_axes.
+    export_options = {'dynamo': False} if 'dynamo' in inspect.signature(torch.onnx.export).parameters else {}
+    with torch.no_grad():
+        torch.onnx.export(LastHiddenState(model), tuple(encoded_input[name] for name in input_names), model_file,
+                          input_names=input_names, output_names=['last_hidden_state'],
+                          dynamic_axes={**{name: {0: 'batch', 1: 'sequence'} for name in input_names},
+                                        'last_hidden_state': {0: 'batch', 1: 'sequence'}},
+                          opset_version=opset_version, **export_options)
+    onnx.checker.check_model(model_file)
+    if not quantize:
+        return model_file
+    from onnxruntime.quantization import quantize_dynamic, QuantType
+    quantized_file = os.path.join(output_dir, 'model_int8.onnx')
+    quantize_dynamic(model_file, quantized_file, weight_type=QuantType.QInt8)
+    return quantized_file
+
+
+class OnnxEmbedder:
+    def __init__(self, model_file, num_threads=None):
+        import onnxruntime
+        options = onnxruntime.SessionOptions()
+        options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if num_threads:
+            options.intra_op_num_threads = num_threads
+        self.session = onnxruntime.InferenceSession(model_file, options, providers=['CPUExecutionProvider'])
+        self.input_names = [model_input.name for model_input in self.session.get_inputs()]
+        self.config = AutoConfig.from_pretrained(os.path.dirname(os.path.abspath(model_file)))
+
+    def to(self, device):
+        if str(device) != 'cpu':
+            raise ValueError('The ONNX backend only runs on CPU')
+        return self
+
+    def __call__(self, **encoded_input):
+        # Tensors in, tensors out, as with the transformers model
+        feed = {name: encoded_input[name].cpu().numpy() for name in self.input_names}
+        last_hidden_state = self.session.run(['last_hidden_state'], feed)[0]
+        return types.SimpleNamespace(last_hidden_state=torch.from_numpy(last_hidden_state))
+
+
+def load_model_and_tokenizer(backend, model_ckpt, onnx_model=None):
+    # The ONNX export directory holds the tokenizer saved with it
+    if backend == 'onnx':
+        return AutoTokenizer.from_pretrained(os.path.dirname(os.path.abspath(onnx_model))), OnnxEmbedder(onnx_model)
+    return AutoTokenizer.from_pretrained(model_ckpt), AutoModel.from_pretrained(model_ckpt)
+
+
+def get_model_id(backend, model_ckpt, onnx_model=None):
+    # Identifies the model that produced an embedding, for checkpoints and caches. Quantized
+    # and unquantized exports give slightly different embeddings, so the file is included.
+    if backend == 'onnx':
+        return f'{model_ckpt}|onnx:{os.path.abspath(onnx_model)}'
+    return model_ckpt
@@ -0,0 +1,145 @@
+import os
+import json
+import hashlib
+import numpy as np
+from collections import OrderedDict
+
+
+def normalize_text(text):
+    # Only whitespace is collapsed. The tokenizer splits on whitespace, so this does not
+    # change the embedding, while stronger normalization could.
+    return ' '.join(text.split())
+
+
+class DiskEmbeddingStore:
+    # Fixed-capacity, memory-mapped store of embeddings keyed by 20-byte digests. Slots are
+    # reused oldest first once it is full. The digest -> slot index is rebuilt on load.
+    def __init__(self, path, dim, capacity, model_ckpt):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        meta_file = os.path.join(path, 'meta.json')
+        meta = None
+        if os.path.exists(meta_file):
+            with open(meta_file) as f:
+                meta = json.load(f)
+            if (meta['dim'], meta['capacity'], meta['model_ckpt']) != (dim, capacity, model_ckpt):
+                meta = None
+        self.meta = meta or {'dim': dim, 'capacity': capacity, 'model_ckpt': model_ckpt, 'count': 0}
+        mode = 'r+' if meta else 'w+'
+        self.embeddings = np.lib.format.open_memmap(os.path.join(path, 'embeddings.npy'), mode=mode,
+                                                    dtype=np.float32, shape=(capacity, dim))
+        # Digests are stored as raw bytes, as an 'S20' array would strip trailing zero bytes
+        self.keys = np.lib.format.open_memmap(os.path.join(path, 'keys.npy'), mode=mode,
+                                              dtype=np.uint8, shape=(capacity, 20))
+        filled = min(self.meta['count'], capacity)
+        self.slots = {key.tobytes(): slot for slot, key in enumerate(self.keys[:filled])}
+
+    def __len__(self):
+        return len(self.slots)
+
+    def get(self, key):
+        slot = self.slots.get(key)
+        return None if slot is None else np.array(self.embeddings[slot])
+
+    def put(self, key, vector):
+        if key in self.slots:
+            return
+        slot = self.meta['count'] % self.meta['capacity']
+        if self.meta['count'] >= self.meta['capacity']:
+            self.slots.pop(self.keys[slot].tobytes(), None)
+        self.embeddings[slot] = vector
+        self.keys[slot] = np.frombuffer(key, dtype=np.uint8)
+        self.slots[key] = slot
+        self.meta['count'] += 1
+
+    def close(self):
+        self.embeddings.flush()
+        self.keys.flush()
+        with open(os.path.join(self.path, 'meta.json'), 'w') as f:
+            json.dump(self.meta, f)
+
+
+class EmbeddingCache:
+    # Query embeddings keyed by a hash of the model checkpoint and normalized text, with an
+    # in-memory LRU tier in front of an optional memory-mapped disk tier
+    def __init__(self, model_ckpt, dim, memory_size=100000, disk_path=None, disk_size=1000000):
+        self.model_ckpt = model_ckpt
+        self.memory_size = memory_size
+        self.memory = OrderedDict()
+        self.disk = DiskEmbeddingStore(disk_path, dim, disk_size, model_ckpt) if disk_path else None
+        self.stats = {'lookups': 0, 'batch_duplicates': 0, 'memory_hits': 0, 'disk_hits': 0, 'misses': 0}
+
+    def make_key(self, text):
+        return hashlib.sha1(f'{self.model_ckpt}\0{normalize_text(text)}'.encode('utf-8')).digest()
+
+    def get(self, key):
+        if key in self.memory:
+            self.memory.move_to_end(key)
+            self.stats['memory_hits'] += 1
+            return self.memory[key]
+        vector = self.disk.get(key) if self.disk is not None else None
+        if vector is not None:
+            self.stats['disk_hits'] += 1
+            self.put_memory(key, vector)
+            return vector
+        self.stats['misses'] += 1
+        return None
+
+    def put_memory(self, key, vector):
+        if not self.memory_size:
+            return
+        self.memory[key] = vector
+        if len(self.memory) > self.memory_size:
+            self.memory.popitem(last=False)
+
+    def put(self, key, vector):
+        self.put_memory(key, vector)
+        if self.disk is not None:
+            self.disk.put(key, vector)
+
+    def embed(self, texts, encode):
+        # Returns embeddings for texts in order. Identical texts in the batch are looked up
+        # once, and only cache misses are passed to encode, in one call.
+        positions = OrderedDict()
+        for i, text in enumerate(texts):
+            positions.setdefault(self.make_key(text), []).append(i)
+        self.stats['lookups'] += len(texts)
+        self.stats['batch_duplicates'] += len(texts) - len(positions)
+        embeddings = None
+        missing = []
+        for key, key_positions in positions.items():
+            vector = self.get(key)
+            if vector is None:
+                missing.append(key)
+                continue
+            if embeddings is None:
+                embeddings = np.empty((len(texts), len(vector)), dtype=np.float32)
+            embeddings[key_positions] = vector
+        if missing:
+            encoded = encode([texts[positions[key][0]] for key in missing])
+            if embeddings is None:
+                embeddings = np.empty((len(texts), encoded.shape[1]), dtype=np.float32)
+            for key, vector in zip(missing, encoded):
+                embeddings[positions[key]] = vector
+                self.put(key, vector.copy())
+        return embeddings
+
+    def get_stats(self):
+        stats = dict(self.stats)
+        unique_lookups = stats['lookups'] - stats['batch_duplicates']
+        hits = stats['memory_hits'] + stats['disk_hits']
+        stats['hit_rate'] = hits / unique_lookups if unique_lookups else 0.0
+        stats['encoded_rate'] = stats['misses'] / stats['lookups'] if stats['lookups'] else 0.0
+        stats['memory_entries'] = len(self.memory)
+        stats['disk_entries'] = len(self.disk) if self.disk is not None else 0
+        return stats
+
+    def write_stats_to_csv(self, filename='embedding_cache_stats.csv'):
+        with open(filename, 'w') as f_out:
+            f_out.write('Metric,Value\n')
+            for metric, value in self.get_stats().items():
+                f_out.write(f'{metric},{value:.4f}\n' if isinstance(value, float) else f'{metric},{value}\n')
+
+    def close(self):
+        if self.disk is not None:
+            self.disk.close()
@@ -0,0 +1,85 @@
+import os
+import json
+import array
+import numpy as np
+
+# Columnar store for the index position -> label and affiliation mapping. It is a
+# directory holding:
+#   label_codes.npy          int32 code into the label vocabulary, per index position
+#   labels.json              the label vocabulary
+#   affiliation_offsets.npy  int64 start offset of each affiliation in the blob, plus the end
+#   affiliations.bin         UTF-8 affiliation text, concatenated
+# The arrays are memory-mapped when loaded, so lookups are array gathers rather than
+# per-row Python objects.
+
+
+class MappingStoreWriter:
+    def __init__(self, path):
+        self.path = path
+        os.makedirs(path, exist_ok=True)
+        self.vocabulary = {}
+        self.label_codes = array.array('i')
+        self.offsets = array.array('q', [0])
+        self.f_blob = open(os.path.join(path, 'affiliations.bin'), 'wb')
+
+    def add(self, labels, affiliations):
+        for label, affiliation in zip(labels, affiliations):
+            self.label_codes.append(self.vocabulary.setdefault(label, len(self.vocabulary)))
+            encoded = affiliation.encode('utf-8') if isinstance(affiliation, str) else b''
+            self.f_blob.write(encoded)
+            self.offsets.append(self.offsets[-1] + len(encoded))
+
+    def close(self):
+        self.f_blob.close()
+        np.save(os.path.join(self.path, 'label_codes.npy'), np.frombuffer(self.label_codes, dtype=np.int32))
+        np.save(os.path.join(self.path, 'affiliation_offsets.npy'), np.frombuffer(self.offsets, dtype=np.int64))
+        with open(os.path.join(self.path, 'labels.json'), 'w') as f:
+            json.dump({'vocabulary': list(self.vocabulary)}, f)
+
+
+class MappingStore:
+    def __init__(self, label_codes, vocabulary, offsets, blob):
+        self.label_codes = label_codes
+        # A trailing None, so the code -1 used for missing neighbors resolves to no label
+        self.vocabulary = np.array(list(vocabulary) + [None], dtype=object)
+        self.offsets = offsets
+        self.blob = blob
+
+    @classmethod
+    def load(cls, path):
+        with open(os.path.join(path, 'labels.json')) as f:
+            vocabulary = json.load(f)['vocabulary']
+        blob_file = os.path.join(path, 'affiliations.bin')
+        blob = np.memmap(blob_file, dtype=np.uint8, mode='r') if os.path.getsize(blob_file) else np.empty(0, dtype=np.uint8)
+        return cls(np.load(os.path.join(path, 'label_codes.npy'), mmap_mode='r'), vocabulary,
+                   np.load(os.path.join(path, 'affiliation_offsets.npy'), mmap_mode='r'), blob)
+
+    @classmethod
+    def from_dict(cls, mapping):
+        # Converts a mapping pickled by earlier versions of build.py, held in memory
+        vocabulary = {}
+        label_codes = [vocabulary.setdefault(mapping[i]['label'], len(vocabulary)) for i in range(len(mapping))]
+        encoded = [mapping[i]['affiliation'].encode('utf-8') if isinstance(mapping[i]['affiliation'], str) else b''
+                   for i in range(len(mapping))]
+        offsets = np.concatenate([[0], np.cumsum([len(e) for e in encoded], dtype=np.int64)])
+        return cls(np.array(label_codes, dtype=np.int32), list(vocabulary), offsets,
+                   np.frombuffer(b''.join(encoded), dtype=np.uint8))
+
+    def __len__(self):
+        return len(self.label_codes)
+
+    def get_labels(self, ids):
+        # Labels for an array of index positions of any shape, such as the I matrix
+        # returned by index.search, with None for -1
+        ids = np.asarray(ids)
+        codes = np.where(ids >= 0, self.label_codes[np.where(ids >= 0, ids, 0)], -1)
+        return self.vocabulary[codes]
+
+    def get_affiliation(self, i):
+        return bytes(self.blob[self.offsets[i]:self.offsets[i + 1]]).decode('utf-8')
+
+    def __getitem__(self, i):
+        # Negative ids are the -1 returned for missing neighbors, not positions from the end
+        if i < 0 or i >= len(self):
+            raise IndexError(f'Index position {i} out of range')
+        return {'label': self.vocabulary[self.label_codes[i]], 'affiliation': self.get_affiliation(i)}
@@ -1,11 +1,18 @@
+import os
 import csv
+import json
+import time
 import argparse
+import itertools
 import pickle
 import logging
 import faiss
 import torch
+import numpy as np
 from datetime import datetime
-from transformers import AutoTokenizer, AutoModel
+from mapping_store import MappingStore
+from embedding_cache import EmbeddingCache
+from onnx_backend import load_model_and_tokenizer, get_model_id
 
 
 def initialize_logging():
@@ -15,21 +22,44 @@ def initialize_logging():
                         format='%(asctime)s %(levelname)s %(message)s')
 
 
-def initialize_model(model_ckpt):
-    embeddings_tokenizer = AutoTokenizer.from_pretrained(model_ckpt)
-    embeddings_model = AutoModel.from_pretrained(model_ckpt)
+def initialize_model(model_ckpt, backend='torch', onnx_model=None):
+    embeddings_tokenizer, embeddings_model = load_model_and_tokenizer(backend, model_ckpt, onnx_model)
     device = torch.device("cpu")
     return embeddings_tokenizer, embeddings_model, device
 
 
-def load_index(index_file):
-    return faiss.read_index(index_file)
+def load_index(index_file, nprobe=None, ef_search=None):
+    # Applies the search parameters stored with the index by build.py, unless overridden
+    index = faiss.read_index(index_file)
+    params = load_index_params(index_file)
+    set_search_params(index, nprobe or params.get('nprobe'), ef_search or params.get('ef_search'))
+    return index
+
+
+def load_index_params(index_file):
+    params_file = f"{index_file}.params.json"
+    if not os.path.exists(params_file):
+        return {'index_type': 'flat'}
+    with open(params_file) as f:
+        return json.load(f)
+
+
+def set_search_params(index, nprobe=None, ef_search=None):
+    ivf_index = faiss.try_extract_index_ivf(index)
+    if ivf_index is not None and nprobe:
+        ivf_index.nprobe = nprobe
+    if isinstance(index, faiss.IndexHNSW) and ef_search:
+        index.hnsw.efSearch = ef_search
 
 
 def load_mapping(mapping_file):
+    # Mapping stores are directories written by build.py. Pickled mapping dicts from
+    # earlier builds are still read, and converted in memory.
+    if os.path.isdir(mapping_file):
+        return MappingStore.load(mapping_file)
     with open(mapping_file, 'rb') as pkl_file:
         mapping = pickle.load(pkl_file)
-    return mapping
+    return MappingStore.from_dict(mapping)
 
 
 def cls_pooling(model_output):
@@ -44,19 +74,168 @@ def get_embeddings(text_list, embeddings_tokenizer, embeddings_model, device):
     return cls_pooling(model_output).detach().cpu().numpy()
 
 
-def faiss_search(affiliation, ror_id, index, mapping, embeddings_tokenizer, embeddings_model, device):
-    query_embedding = get_embeddings(
-        [affiliation], embeddings_tokenizer, embeddings_model, device)
-    D, I = index.search(query_embedding, k=20)
-    nearest_indices = I[0]
-    nearest_info = [mapping[i] for i in nearest_indices]
-    nearest_labels = [info['label'] for info in nearest_info]
+def get_query_embeddings(text_list, embeddings_tokenizer, embeddings_model, device, embedding_cache=None):
+    def encode(texts):
+        with torch.inference_mode():
+            return get_embeddings(texts, embeddings_tokenizer, embeddings_model, device)
+    if embedding_cache is None:
+        return encode(text_list)
+    return embedding_cache.embed(text_list, encode)
+
+
+def embed_queries(texts, embeddings_tokenizer, embeddings_model, device, batch_size=64):
+    embeddings = np.empty((len(texts), embeddings_model.config.hidden_size), dtype=np.float32)
+    with torch.inference_mode():
+        for start in range(0, len(texts), batch_size):
+            embeddings[start:start + batch_size] = get_embeddings(
+                texts[start:start + batch_size], embeddings_tokenizer, embeddings_model, device)
+    return embeddings
+
+
+def benchmark_configuration(configuration, index, query_embeddings, true_distances, k):
+    # Queries are searched one at a time, as in parse_and_query, so the latencies are per
+    # query. A result counts as a true neighbor if it is no farther than the exact k-th (or
+    # first) neighbor, so ties between duplicate affiliations are not counted as misses.
+    latencies = np.empty(len(query_embeddings))
+    found_distances = np.empty((len(query_embeddings), k), dtype=np.float32)
+    for i in range(len(query_embeddings)):
+        start = time.perf_counter()
+        D, I = index.search(query_embeddings[i:i + 1], k)
+        latencies[i] = time.perf_counter() - start
+        found_distances[i] = np.where(I[0] >= 0, D[0], np.inf)
+    tolerance = 1e-5 * np.maximum(1.0, true_distances)
+    recall_at_1 = np.mean(found_distances[:, 0] <= true_distances[:, 0] + tolerance[:, 0])
+    recall_at_k = np.mean(np.sum(found_distances <= (true_distances[:, -1] + tolerance[:, -1])[:, None], axis=1) / k)
+    p50, p90, p99 = np.percentile(latencies * 1000, [50, 90, 99])
+    return {'configuration': configuration, 'recall@1': recall_at_1, f'recall@{k}': recall_at_k,
+            'mean_ms': latencies.mean() * 1000, 'p50_ms': p50, 'p90_ms': p90, 'p99_ms': p99}
+
+
+def benchmark_index(index, index_type, flat_index, query_embeddings, search_values, k=10):
+    # Recall is measured against exact search over the flat index. IVF indexes are swept
+    # over nprobe and HNSW indexes over efSearch.
+    true_distances, _ = flat_index.search(query_embeddings, k)
+    results = [benchmark_configuration('flat', flat_index, query_embeddings, true_distances, k)]
+    for value in search_values if index_type != 'flat' else []:
+        if index_type == 'ivf_flat':
+            set_search_params(index, nprobe=value)
+            configuration = f'ivf_flat nprobe={value}'
+        else:
+            set_search_params(index, ef_search=value)
+            configuration = f'hnsw efSearch={value}'
+        results.append(benchmark_configuration(configuration, index, query_embeddings, true_distances, k))
+    return results
+
+
+def benchmark_label_search(configuration, index_file, index, mapping, query_embeddings, ror_ids, k):
+    # Searches queries one at a time for the k neighbors matching reads from this index,
+    # and scores their labels against the expected ROR IDs as parse_and_query does
+    latencies = np.empty(len(query_embeddings))
+    predicted_ror_ids = []
+    in_top_10 = 0
+    for i in range(len(query_embeddings)):
+        start = time.perf_counter()
+        D, I = index.search(query_embeddings[i:i + 1], k)
+        latencies[i] = time.perf_counter() - start
+        nearest_labels = mapping.get_labels(I[0])
+        predicted_ror_ids.append(nearest_labels[0])
+        in_top_10 += ror_ids[i] in nearest_labels
+    p50, p90, p99 = np.percentile(latencies * 1000, [50, 90, 99])
+    result = {'configuration': configuration, 'vectors': index.ntotal,
+              'index_mb': os.path.getsize(index_file) / 2 ** 20,
+              'recall@1': np.mean([p == r for p, r in zip(predicted_ror_ids, ror_ids)]),
+              'in_top_10': in_top_10 / len(ror_ids),
+              'mean_ms': latencies.mean() * 1000, 'p50_ms': p50, 'p90_ms': p90, 'p99_ms': p99}
+    return result, predicted_ror_ids
+
+
+def benchmark_aggregate_index(index_file, index, mapping, params, compare_index_file, compare_mapping_file,
+                              query_embeddings, ror_ids):
+    # Compares an index of per-label centroids with the per-affiliation index built from
+    # the same data. Recall is of the expected ROR ID, and agreement is how often the two
+    # indexes predict the same ROR ID.
+    compare_index = load_index(compare_index_file)
+    compare_results, compare_predictions = benchmark_label_search(
+        'per-affiliation', compare_index_file, compare_index, load_mapping(compare_mapping_file), query_embeddings,
+        ror_ids, load_index_params(compare_index_file).get('search_k', 20))
+    results, predictions = benchmark_label_search(
+        f"{params['aggregate']} centroids_per_label={params['centroids_per_label']}", index_file, index, mapping,
+        query_embeddings, ror_ids, params['search_k'])
+    compare_results['agreement'] = 1.0
+    results['agreement'] = np.mean([p == c for p, c in zip(predictions, compare_predictions)])
+    return [compare_results, results]
+
+
+def write_benchmark_results(results, output_file):
+    with open(output_file, 'w', newline='') as f_out:
+        writer = csv.DictWriter(f_out, fieldnames=list(results[0].keys()))
+        writer.writeheader()
+        for result in results:
+            writer.writerow({key: f'{value:.4f}' if isinstance(value, float) else value
+                             for key, value in result.items()})
+
+
+def faiss_search(affiliation, ror_id, index, mapping, embeddings_tokenizer, embeddings_model, device, embedding_cache=None,
+                 k=20):
+    query_embedding = get_query_embeddings(
+        [affiliation], embeddings_tokenizer, embeddings_model, device, embedding_cache)
+    D, I = index.search(query_embedding, k=k)
+    # IVF and HNSW indexes return -1 for missing neighbors, which get_labels resolves to None
+    nearest_labels = mapping.get_labels(I[0]).tolist()
     in_top_10 = True if ror_id in nearest_labels else False
     predicted_ror_id = nearest_labels[0]
     return predicted_ror_id, in_top_10
 
 
-def parse_and_query(index, mapping, input_file, output_file, embeddings_tokenizer, embeddings_model, device):
+def faiss_search_batch(affiliations, ror_ids, index, mapping, embeddings_tokenizer, embeddings_model, device, embedding_cache=None,
+                       k=20):
+    # Embeds the batch in one forward pass, searches it with one index.search call and
+    # resolves the returned neighbor matrix to labels with array indexing
+    query_embeddings = get_query_embeddings(
+        affiliations, embeddings_tokenizer, embeddings_model, device, embedding_cache)
+    D, I = index.search(query_embeddings, k=k)
+    nearest_labels = mapping.get_labels(I)
+    in_top_10 = (nearest_labels == np.array(ror_ids, dtype=object)[:, None]).any(axis=1)
+    return nearest_labels[:, 0].tolist(), in_top_10.tolist()
+
+
+def parse_and_query_batched(index, mapping, input_file, output_file, embeddings_tokenizer, embeddings_model, device, batch_size,
+                            embedding_cache=None, k=20):
+    try:
+        with open(input_file, 'r+', encoding='utf-8-sig') as f_in, open(output_file, 'w') as f_out:
+            reader = csv.DictReader(f_in)
+            fieldnames = reader.fieldnames + \
+                ["ner_form", "predicted_ror_id", "match", "in_top_10"]
+            writer = csv.DictWriter(f_out, fieldnames=fieldnames)
+            writer.writeheader()
+            while True:
+                chunk = list(itertools.islice(reader, batch_size))
+                if not chunk:
+                    break
+                results = [(None, None)] * len(chunk)
+                positions = [i for i, row in enumerate(chunk) if row['affiliation']]
+                if positions:
+                    predicted_ror_ids, in_top_10s = faiss_search_batch(
+                        [chunk[i]['affiliation'] for i in positions], [chunk[i]['ror_id'] for i in positions],
+                        index, mapping, embeddings_tokenizer, embeddings_model, device, embedding_cache, k)
+                    for i, predicted_ror_id, in_top_10 in zip(positions, predicted_ror_ids, in_top_10s):
+                        results[i] = (predicted_ror_id, in_top_10)
+                for row, (predicted_ror_id, in_top_10) in zip(chunk, results):
+                    ror_id = row['ror_id']
+                    match = 'Y' if predicted_ror_id and predicted_ror_id == ror_id else (
+                        'NP' if not predicted_ror_id else 'N')
+                    row.update({
+                        "predicted_ror_id": predicted_ror_id,
+                        "match": match,
+                        "in_top_10": in_top_10
+                    })
+                    writer.writerow(row)
+    except Exception as e:
+        logging.error(f'Error in parse_and_query_batched: {e}')
+
+
+def parse_and_query(index, mapping, input_file, output_file, embeddings_tokenizer, embeddings_model, device, embedding_cache=None,
+                    k=20):
     try:
         with open(input_file, 'r+', encoding='utf-8-sig') as f_in, open(output_file, 'w') as f_out:
             reader = csv.DictReader(f_in)
@@ -67,8 +246,9 @@ def parse_and_query(index, mapping, input_file, output_file, embeddings_tokenize
             for row in reader:
                 affiliation = row['affiliation']
                 ror_id = row['ror_id']
-                predicted_ror_id, in_top_10 = faiss_search(
-                    affiliation, ror_id, index, mapping, embeddings_tokenizer, embeddings_model, device)
+                if affiliation:
+                    predicted_ror_id, in_top_10 = faiss_search(
+                        affiliation, ror_id, index, mapping, embeddings_tokenizer, embeddings_model, device, embedding_cache, k)
                 else:
                     predicted_ror_id, in_top_10 = None, None
                 match = 'Y' if predicted_ror_id and predicted_ror_id == ror_id else (
@@ -93,9 +273,39 @@ def parse_arguments():
     parser.add_argument(
         '-i', '--index_file', help='Index file', required=True)
     parser.add_argument(
-        '-m', '--mapping_file', help='Mapping file for index to affiliations and labels', required=True)
+        '-m', '--mapping_file', help='Mapping store directory (or pickled mapping file from earlier builds) for index to affiliations and labels', required=True)
     parser.add_argument(
         '-c', '--model_ckpt', help='Checkpoint for the embeddings model', default="sentence-transformers/multi-qa-mpnet-base-dot-v1")
+    parser.add_argument(
+        '--backend', help='Run the embeddings model with PyTorch, or with ONNX Runtime from an export_onnx.py export', choices=['torch', 'onnx'], default='torch')
+    parser.add_argument(
+        '--onnx_model', help='ONNX model file written by export_onnx.py, used with --backend onnx', default='onnx_model/model.onnx')
+    parser.add_argument(
+        '--nprobe', help='Number of IVF clusters to visit, overriding the value stored with the index', type=int, default=None)
+    parser.add_argument(
+        '--ef_search', help='HNSW candidate list size, overriding the value stored with the index', type=int, default=None)
+    parser.add_argument(
+        '-b', '--batch_size', help='Number of affiliations to embed and search together (1 searches row by row)', type=int, default=1)
+    parser.add_argument(
+        '--embedding_cache_size', help='Number of query embeddings kept in the in-memory cache (0 disables it)', type=int, default=100000)
+    parser.add_argument(
+        '--embedding_cache_dir', help='Directory for a memory-mapped on-disk query embedding cache shared across runs', default=None)
+    parser.add_argument(
+        '--embedding_cache_disk_size', help='Number of query embeddings kept in the on-disk cache', type=int, default=1000000)
+    parser.add_argument(
+        '--no_embedding_cache', help='Embed every query, without caching or deduplicating identical affiliations', action='store_true')
+    parser.add_argument(
+        '-B', '--benchmark', help='Report recall@1/@10 against a flat index and query latency for the input affiliations instead of matching', action='store_true')
+    parser.add_argument(
+        '--flat_index', help='Flat index built from the same data, used as ground truth in benchmark mode')
+    parser.add_argument(
+        '--search_values', help='Comma separated nprobe (IVF) or efSearch (HNSW) values to benchmark', default=None)
+    parser.add_argument(
+        '--benchmark_output', help='Output CSV file for benchmark results', default='index_benchmark_results.csv')
+    parser.add_argument(
+        '--compare_index', help='Per-affiliation index built from the same data, compared against in benchmark mode for a centroid index')
+    parser.add_argument(
+        '--compare_mapping', help='Mapping store for --compare_index')
 
     return parser.parse_args()
 
@@ -104,11 +314,51 @@ def main():
     args = parse_arguments()
     initialize_logging()
     embeddings_tokenizer, embeddings_model, device = initialize_model(
-        args.model_ckpt)
-    index = load_index(args.index_file)
+        args.model_ckpt, args.backend, args.onnx_model)
+    index = load_index(args.index_file, args.nprobe, args.ef_search)
+    params = load_index_params(args.index_file)
+    if args.benchmark and params.get('aggregate'):
+        if not args.compare_index or not args.compare_mapping:
+            raise SystemExit('--compare_index and --compare_mapping are required to benchmark a centroid index')
+        with open(args.input, 'r+', encoding='utf-8-sig') as f_in:
+            rows = [row for row in csv.DictReader(f_in) if row['affiliation']]
+        query_embeddings = embed_queries([row['affiliation'] for row in rows], embeddings_tokenizer,
+                                         embeddings_model, device)
+        results = benchmark_aggregate_index(args.index_file, index, load_mapping(args.mapping_file), params,
+                                            args.compare_index, args.compare_mapping, query_embeddings,
+                                            [row['ror_id'] for row in rows])
+        write_benchmark_results(results, args.benchmark_output)
+        return
+    if args.benchmark:
+        index_type = params['index_type']
+        if index_type != 'flat' and not args.flat_index:
+            raise SystemExit('--flat_index is required to benchmark an approximate index')
+        flat_index = load_index(args.flat_index) if args.flat_index else index
+        default_values = '1,4,16,64' if index_type == 'ivf_flat' else '16,32,64,128'
+        search_values = [int(value) for value in (args.search_values or default_values).split(',')]
+        with open(args.input, 'r+', encoding='utf-8-sig') as f_in:
+            affiliations = [row['affiliation'] for row in csv.DictReader(f_in) if row['affiliation']]
+        query_embeddings = embed_queries(affiliations, embeddings_tokenizer, embeddings_model, device)
+        results = benchmark_index(index, index_type, flat_index, query_embeddings, search_values)
+        write_benchmark_results(results, args.benchmark_output)
+        return
     mapping = load_mapping(args.mapping_file)
-    parse_and_query(index, mapping, args.input, args.output, embeddings_tokenizer,
-                    embeddings_model, device)
+    embedding_cache = None
+    if not args.no_embedding_cache:
+        embedding_cache = EmbeddingCache(get_model_id(args.backend, args.model_ckpt, args.onnx_model),
+                                         embeddings_model.config.hidden_size, args.embedding_cache_size,
+                                         args.embedding_cache_dir, args.embedding_cache_disk_size)
+    # Centroid indexes store how many neighbors to read, enough to cover 10 labels
+    k = params.get('search_k', 20)
+    if args.batch_size > 1:
+        parse_and_query_batched(index, mapping, args.input, args.output, embeddings_tokenizer,
+                                embeddings_model, device, args.batch_size, embedding_cache, k)
+    else:
+        parse_and_query(index, mapping, args.input, args.output, embeddings_tokenizer,
+                        embeddings_model, device, embedding_cache, k)
+    if embedding_cache:
+        embedding_cache.close()
+        embedding_cache.write_stats_to_csv()
 
 
 if __name__ == '__main__':